@@ -2,18 +2,21 @@
 
 # An Early parser
 
-import itertools
+import math
+import re
 from typing import (
     Callable,
-    Generator,
+    Dict,
+    FrozenSet,
     Iterable,
     Iterator,
     List,
     NamedTuple,
-    NewType,
     Optional,
+    Pattern,
     Set,
     Tuple,
+    TypeVar,
     Union,
     Any,  # NOTE: using this until mypy supports recursive types
 )
@@ -23,6 +26,22 @@ import unittest
 class Symbol(NamedTuple):
     name: str
     pred: Optional[Callable[[str], bool]] = None
+    # Terminals matching a fixed token or a regex are scanned through an
+    # index instead of calling pred on each item, use exact/regex to build them
+    literal: Optional[str] = None
+    pattern: Optional[str] = None
+
+    @staticmethod
+    def exact(literal: str, name: Optional[str] = None) -> 'Symbol':
+        "Terminal matching exactly literal"
+        return Symbol(name or literal, lambda x: x == literal, literal=literal)
+
+    @staticmethod
+    def regex(name: str, pattern: str) -> 'Symbol':
+        "Terminal matching tokens that fully match pattern"
+        compiled: Pattern[str] = re.compile(pattern)
+        return Symbol(name, lambda x: compiled.fullmatch(x) is not None,
+                      pattern=pattern)
 
     def is_terminal(self) -> bool:
         return self.pred is not None
@@ -40,6 +59,25 @@ class Rule(NamedTuple):
         return f"{self.head} -> {body}"
 
 
+# NOTE: List[ASTNode] when mypy supports recursive types
+# ASTNode = Union[str, Tuple[str, List['ASTNode']]]
+ASTNode = Union[str, Tuple[str, List[Any]]]
+
+
+class NullDerivation:
+    """
+    Trigger of back-pointers that advance over a nullable non-terminal without
+    consuming input. The empty derivations of name are shared, not enumerated:
+    each alternative is a rule of name (its id and str) with the NullDerivation
+    of every symbol in its spec.
+    """
+    __slots__ = ("name", "alternatives")
+
+    def __init__(self, name: str) -> None:
+        self.name: str = name
+        self.alternatives: List[Tuple[int, str, List['NullDerivation']]] = []
+
+
 class Grammar(NamedTuple):
     start: str
     rules_: List[Rule]
@@ -47,38 +85,178 @@ class Grammar(NamedTuple):
     def rules(self, start: str) -> List[Rule]:
         return [r for r in self.rules_ if r.head == start]
 
+    def compile(self) -> 'CompiledGrammar':
+        return CompiledGrammar(self)
+
+
+class CompiledGrammar:
+    """
+    Grammar indexed for parsing. Repeated rules are kept once, each rule gets
+    an integer id (its position in rules), rules are indexed by head, nullable
+    non-terminals and the closure of rules each non-terminal predicts are
+    precomputed, and every rule is flattened into the symbol after each dot.
+    """
+    def __init__(self, grammar: Grammar) -> None:
+        self.start: str = grammar.start
+        # Equal rules derive the same trees, keep one so parses aren't counted twice
+        unique: Dict[Tuple[str, Tuple[Symbol, ...]], Rule] = {}
+        for rule in grammar.rules_:
+            unique.setdefault((rule.head, tuple(rule.spec)), rule)
+        self.rules: List[Rule] = list(unique.values())
+        self.rule_names: List[str] = [str(rule) for rule in self.rules]
+        self.rules_by_head: Dict[str, List[int]] = {}
+        for rule_id, rule in enumerate(self.rules):
+            self.rules_by_head.setdefault(rule.head, []).append(rule_id)
+        # next_symbol[rule_id][dot]: symbol after the dot, None once complete
+        self.next_symbol: List[Tuple[Optional[Symbol], ...]] = [
+            tuple(rule.spec) + (None,) for rule in self.rules]
+        self.nullable: Set[str] = self._nullable(self.rules)
+        self.null_derivations: Dict[str, NullDerivation] = self._null_derivations()
+        # Regex terminals get an id, patterns are compiled on their own so
+        # flags, backreferences and group names can't clash between them.
+        # Hits are memoized per lexeme as tokens repeat a lot.
+        self.pattern_ids: Dict[str, int] = {}
+        for rule in self.rules:
+            for sym in rule.spec:
+                if sym.pattern is not None and sym.literal is None:
+                    self.pattern_ids.setdefault(sym.pattern, len(self.pattern_ids))
+        self.patterns: List[Pattern[str]] = [
+            re.compile(pattern) for pattern in self.pattern_ids]
+        self.pattern_matches: Dict[str, List[int]] = {}
+        # Non-terminals transitively predicted by each one, and their rules
+        self.predicted_nonterms: Dict[str, FrozenSet[str]] = {
+            name: self._prediction_closure(name)
+            for name in {sym.name for rule in self.rules for sym in rule.spec
+                         if sym.is_nonterm()} | set(self.rules_by_head)}
+        self.predictions: Dict[str, FrozenSet[int]] = {
+            name: frozenset(rule_id for nonterm in nonterms
+                            for rule_id in self.rules_by_head.get(nonterm, []))
+            for name, nonterms in self.predicted_nonterms.items()}
+
+    @staticmethod
+    def _nullable(rules: List[Rule]) -> Set[str]:
+        "Non-terminals that can derive the empty string"
+        nullable: Set[str] = set()
+        prev_count: Optional[int] = None
+        while len(nullable) != prev_count:
+            prev_count = len(nullable)
+            nullable.update(
+                rule.head for rule in rules
+                if all(sym.is_nonterm() and sym.name in nullable for sym in rule.spec))
+        return nullable
+
+    def _prediction_closure(self, name: str) -> FrozenSet[str]:
+        "Non-terminals predicted by predicting name, past nullable prefixes too"
+        closure: Set[str] = {name}
+        pending: List[str] = [name]
+        while pending:
+            for rule_id in self.rules_by_head.get(pending.pop(), []):
+                for sym in self.rules[rule_id].spec:
+                    if sym.is_terminal():
+                        break
+                    if sym.name not in closure:
+                        closure.add(sym.name)
+                        pending.append(sym.name)
+                    if sym.name not in self.nullable:
+                        break
+        return frozenset(closure)
+
+    def matching_patterns(self, lexeme: str) -> List[int]:
+        "Ids of the regex terminals matching lexeme"
+        matches: Optional[List[int]] = self.pattern_matches.get(lexeme)
+        if matches is None:
+            if len(self.pattern_matches) >= 1 << 16:
+                self.pattern_matches.clear()
+            matches = self.pattern_matches[lexeme] = [
+                pattern_id for pattern_id, pattern in enumerate(self.patterns)
+                if pattern.fullmatch(lexeme) is not None]
+        return matches
+
+    def _null_derivations(self) -> Dict[str, NullDerivation]:
+        """
+        Empty derivations of each nullable non-terminal. Rules that would make
+        them cyclic (X -> X) are skipped, otherwise there'd be infinitely many.
+        """
+        derivations: Dict[str, NullDerivation] = {
+            name: NullDerivation(name) for name in self.nullable}
+        null_rules: List[int] = [
+            rule_id for rule_id, rule in enumerate(self.rules)
+            if all(sym.is_nonterm() and sym.name in self.nullable for sym in rule.spec)]
+        # Height of the shortest empty derivation of each non-terminal. Rules
+        # whose symbols are all lower can't close a cycle, add them first so
+        # every nullable keeps at least one derivation.
+        height: Dict[str, int] = {}
+        while len(height) < len(derivations):
+            level: int = len(set(height.values()))
+            height.update({
+                self.rules[rule_id].head: level for rule_id in null_rules
+                if self.rules[rule_id].head not in height and
+                all(sym.name in height for sym in self.rules[rule_id].spec)})
+
+        def lower(rule_id: int) -> bool:
+            rule: Rule = self.rules[rule_id]
+            return all(height[sym.name] < height[rule.head] for sym in rule.spec)
+
+        def reaches(start: NullDerivation, target: NullDerivation) -> bool:
+            seen: Set[int] = set()
+            pending: List[NullDerivation] = [start]
+            while pending:
+                derivation: NullDerivation = pending.pop()
+                if derivation is target:
+                    return True
+                if id(derivation) not in seen:
+                    seen.add(id(derivation))
+                    pending.extend(child for _, _, children in derivation.alternatives
+                                   for child in children)
+            return False
+
+        for rule_id in sorted(null_rules, key=lambda rule_id: not lower(rule_id)):
+            head: NullDerivation = derivations[self.rules[rule_id].head]
+            children: List[NullDerivation] = [
+                derivations[sym.name] for sym in self.rules[rule_id].spec]
+            if lower(rule_id) or not any(reaches(child, head) for child in children):
+                head.alternatives.append((rule_id, self.rule_names[rule_id], children))
+        for derivation in derivations.values():
+            derivation.alternatives.sort(key=lambda alternative: alternative[0])
+        return derivations
+
 
 # What is the source of an item? either a completion, or the scan of a lexeme
-BackPointer = Union[Tuple['Item', 'Item'], Tuple['Item', str]]
+# or advancing over a nullable non-terminal, or a chain of Leo completions
+BackPointer = Union[Tuple['Item', 'Item'], Tuple['Item', str],
+                    Tuple['Item', NullDerivation], Tuple['Item', 'LeoTrigger']]
 
 
 class Item:
+    __slots__ = ("rule", "rule_id", "dot", "start", "end", "backpointers", "key", "hash_")
+
     def __init__(
         self,
         rule: Rule,
+        rule_id: int,
         dot: int,
         start: int,
         end: int,
         backpointers: Set[BackPointer]
     ) -> None:
         self.rule: Rule = rule
+        self.rule_id: int = rule_id  # id of rule in its CompiledGrammar
         self.dot: int = dot
         self.start: int = start
         self.end: int = end
         self.backpointers: Set[BackPointer] = backpointers
+        # Identity of the item, explicitly excluding BackPointers
+        self.key: Tuple[int, int, int, int] = (rule_id, dot, start, end)
+        self.hash_: int = hash(self.key)
 
     def __eq__(self, other: object) -> bool:
         "Explicitly exclude BackPointers"
         assert isinstance(other, Item), "Item expected"
-        return (self.rule == other.rule and
-                self.dot == other.dot and
-                self.start == other.start and
-                self.end == other.end)
+        return self.key == other.key
 
     def __hash__(self) -> int:
         "Explicitly exclude BackPointers"
-        rule_hash = hash((self.rule.head, tuple(self.rule.spec)))
-        return hash((rule_hash, self.dot, self.start, self.end))
+        return self.hash_
 
     def __str__(self) -> str:
         pre: str = " ".join(sym.name for sym in self.rule.spec[:self.dot])
@@ -89,16 +267,17 @@ class Item:
                 )  # f" #bp: {{{backpointers}}}|")
 
     @staticmethod
-    def predict(rule: Rule, start: int) -> 'Item':
-        return Item(rule, 0, start, start, set())
+    def predict(rule: Rule, rule_id: int, start: int) -> 'Item':
+        return Item(rule, rule_id, 0, start, start, set())
 
     @staticmethod
-    def complete(src: 'Item', trig: 'Item', at: int) -> 'Item':
-        return Item(src.rule, src.dot + 1, src.start, at, {(src, trig)})
+    def complete(src: 'Item', trig: Union['Item', NullDerivation, 'LeoTrigger'],
+                 at: int) -> 'Item':
+        return Item(src.rule, src.rule_id, src.dot + 1, src.start, at, {(src, trig)})
 
     @staticmethod
     def scan(src: 'Item', end: int, input: str) -> 'Item':
-        return Item(src.rule, src.dot + 1, src.start, end, {(src, input)})
+        return Item(src.rule, src.rule_id, src.dot + 1, src.start, end, {(src, input)})
 
     def is_complete(self) -> bool:
         return self.dot >= len(self.rule.spec)
@@ -118,158 +297,556 @@ class Item:
                 if len(self.rule.spec) > self.dot else None)
 
 
-StateSet = NewType("StateSet", Set[Item])
+class LeoPath:
+    """
+    Deterministic reduction path memoized per StateSet (Joop Leo, 1991).
+    When source is the only item of its set waiting on a non-terminal and that
+    non-terminal is the last symbol of its rule, completing it completes source
+    too, and whatever source's completion completes further up. Items along the
+    path are skipped, only the item completed from top gets into the set.
+    """
+    __slots__ = ("source", "up", "top")
 
-# NOTE: List[ASTNode] when mypy supports recursive types
-# ASTNode = Union[str, Tuple[str, List['ASTNode']]]
-ASTNode = Union[str, Tuple[str, List[Any]]]
+    def __init__(self, source: Item, up: Optional['LeoPath']) -> None:
+        self.source: Item = source
+        self.up: Optional[LeoPath] = up
+        self.top: Item = source if up is None else up.top
+
+
+class LeoTrigger:
+    """
+    Trigger of the back-pointer of an item completed through a LeoPath.
+    The skipped items are only built when extracting trees.
+    """
+    __slots__ = ("path", "trigger", "at", "item_")
+
+    def __init__(self, path: LeoPath, trigger: Item, at: int) -> None:
+        self.path: LeoPath = path
+        self.trigger: Item = trigger
+        self.at: int = at
+        self.item_: Optional[Item] = None
+
+    def item(self) -> Item:
+        "The completed item right below the top of the path"
+        if self.item_ is None:
+            item: Item = self.trigger
+            path: LeoPath = self.path
+            while path.up is not None:
+                item = Item.complete(path.source, item, self.at)
+                path = path.up
+            self.item_ = item
+        return self.item_
+
+
+class StateSet:
+    """
+    Items of an Earley set in insertion order, which doubles as the parser's
+    worklist, plus an index to find an item equal to a new one in O(1).
+    Also indexes items by the non-terminal they're waiting on for completion.
+    """
+    def __init__(self, grammar: CompiledGrammar, items: Iterable[Item] = ()) -> None:
+        self.next_symbol: List[Tuple[Optional[Symbol], ...]] = grammar.next_symbol
+        self.items: List[Item] = []
+        self.index: Dict[Tuple[int, int, int, int], Item] = {}
+        self.waiting: Dict[str, List[Item]] = {}
+        # Items waiting on a terminal to be scanned, and the same items indexed
+        # by literal, by regex terminal id, or when they need pred to tell
+        self.scanning: List[Item] = []
+        self.scan_literals: Dict[str, List[Item]] = {}
+        self.scan_patterns: Dict[int, List[Item]] = {}
+        self.scan_preds: List[Item] = []
+        self.pattern_ids: Dict[str, int] = grammar.pattern_ids
+        # Memoized LeoPaths by non-terminal, filled once the set is complete
+        self.leo: Dict[str, Optional[LeoPath]] = {}
+        for item in items:
+            self.add(item)
+
+    def add(self, item: Item) -> Item:
+        "Add item or merge its back-pointers into an existing equal one"
+        existent: Optional[Item] = self.index.get(item.key)
+        if existent is not None:
+            existent.backpointers.update(item.backpointers)
+            return existent
+        self.index[item.key] = item
+        self.items.append(item)
+        next_sym: Optional[Symbol] = self.next_symbol[item.rule_id][item.dot]
+        if next_sym is not None:
+            if next_sym.pred is None:
+                self.waiting.setdefault(next_sym.name, []).append(item)
+            else:
+                self.scanning.append(item)
+                if next_sym.literal is not None:
+                    self.scan_literals.setdefault(next_sym.literal, []).append(item)
+                elif next_sym.pattern is not None:
+                    self.scan_patterns.setdefault(
+                        self.pattern_ids[next_sym.pattern], []).append(item)
+                else:
+                    self.scan_preds.append(item)
+        return item
+
+    def predict(self, rules: List[Rule], rule_ids: Iterable[int], at: int) -> None:
+        "Add predictions of rule_ids, skipping those already in the set"
+        index: Dict[Tuple[int, int, int, int], Item] = self.index
+        for rule_id in rule_ids:
+            if (rule_id, 0, at, at) not in index:
+                self.add(Item.predict(rules[rule_id], rule_id, at))
+
+    def scannable(self, grammar: CompiledGrammar, lexeme: str) -> Iterator[Item]:
+        "Items lexeme can advance"
+        yield from self.scan_literals.get(lexeme, ())
+        if self.scan_patterns:
+            for pattern_id in grammar.matching_patterns(lexeme):
+                yield from self.scan_patterns.get(pattern_id, ())
+        for item in self.scan_preds:
+            if item.can_scan(lexeme):
+                yield item
+
+    def __iter__(self) -> Iterator[Item]:
+        return iter(self.items)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+
+def _leo_path(statesets: Dict[int, StateSet], stateset_id: int,
+              name: str, start: str) -> Optional[LeoPath]:
+    "LeoPath for completions of name from statesets[stateset_id], if any"
+    # Walk up the path iteratively, right-recursion may run as deep as the input
+    pending: List[Tuple[StateSet, str, Item]] = []
+    path: Optional[LeoPath] = None
+    while True:
+        stateset: StateSet = statesets[stateset_id]
+        if name in stateset.leo:
+            path = stateset.leo[name]
+            break
+        waiting: List[Item] = stateset.waiting.get(name, [])
+        if len(waiting) != 1 or waiting[0].dot + 1 != len(waiting[0].rule.spec):
+            stateset.leo[name] = None
+            break
+        source: Item = waiting[0]
+        pending.append((stateset, name, source))
+        # Don't skip over items that could be a parse result, nor loop in a set
+        if source.start == stateset_id or (
+                source.start == 0 and source.rule.head == start):
+            break
+        stateset_id, name = source.start, source.rule.head
+    for stateset, name, source in reversed(pending):
+        path = LeoPath(source, path)
+        stateset.leo[name] = path
+    return path
+
+# Children of forest nodes: complete nodes or lexemes
+ForestChild = Union['ForestNode', str]
+T = TypeVar('T')
+U = TypeVar('U')
+
+
+class ForestNode:
+    """
+    Node of a ParseForest, one per item (rule, dot, start, end). Families are
+    the alternative ways of deriving it: the node one dot behind plus the
+    child that moved the dot across. Nodes of empty derivations have no
+    position, they're keyed (rule, dot, -1, -1) and shared by all of them.
+    """
+    __slots__ = ("name", "key", "complete", "families", "family_keys")
+
+    def __init__(self, name: str, key: Tuple[int, int, int, int], complete: bool) -> None:
+        self.name: str = name
+        self.key: Tuple[int, int, int, int] = key
+        self.complete: bool = complete
+        self.families: List[Tuple['ForestNode', ForestChild]] = []
+        self.family_keys: Set[Tuple[int, Union[int, str]]] = set()
+
+    def add_family(self, source: 'ForestNode', child: ForestChild) -> None:
+        family_key = (id(source), child if isinstance(child, str) else id(child))
+        if family_key not in self.family_keys:
+            self.family_keys.add(family_key)
+            self.families.append((source, child))
+
+    def children(self) -> Iterator['ForestNode']:
+        for source, child in self.families:
+            yield source
+            if isinstance(child, ForestNode):
+                yield child
+
+
+class ParseForest:
+    """
+    Shared packed parse forest of the items returned by parse. Items are
+    merged by identity so sub-trees common to many parses are stored once,
+    which keeps the forest polynomial even when the number of trees isn't.
+    All walks are iterative, deep trees don't hit the recursion limit.
+    """
+    def __init__(self, parser_output: Iterable[Item]) -> None:
+        self.nodes: Dict[Tuple[int, int, int, int], ForestNode] = {}
+        parser_output = list(parser_output)
+        self.roots: List[ForestNode] = [self._node(item) for item in parser_output]
+        # Leo may rebuild several Items equal to each other, walk them all
+        walked: Set[int] = set()
+        pending: List[Item] = parser_output
+        while pending:
+            item: Item = pending.pop()
+            if id(item) in walked:
+                continue
+            walked.add(id(item))
+            node: ForestNode = self._node(item)
+            for source, trigger in item.backpointers:
+                pending.append(source)
+                if isinstance(trigger, LeoTrigger):
+                    trigger = trigger.item()
+                if isinstance(trigger, Item):
+                    pending.append(trigger)
+                    node.add_family(self._node(source), self._node(trigger))
+                elif isinstance(trigger, NullDerivation):
+                    for child in self._null_nodes(trigger):
+                        node.add_family(self._node(source), child)
+                else:
+                    node.add_family(self._node(source), trigger)
+        self.order: List[ForestNode] = self._topological_order()
+
+    def _node(self, item: Item) -> ForestNode:
+        node: Optional[ForestNode] = self.nodes.get(item.key)
+        if node is None:
+            node = self.nodes[item.key] = ForestNode(
+                str(item.rule), item.key, item.is_complete())
+        return node
+
+    def _null_nodes(self, derivation: NullDerivation) -> List[ForestNode]:
+        "Complete nodes of each alternative empty derivation"
+        return [self._null_node(rule_id, name, children, len(children))
+                for rule_id, name, children in derivation.alternatives]
+
+    def _null_node(self, rule_id: int, name: str, children: List[NullDerivation],
+                   dot: int) -> ForestNode:
+        # Recursion is bound by the grammar, empty derivations aren't cyclic
+        key: Tuple[int, int, int, int] = (rule_id, dot, -1, -1)
+        node: Optional[ForestNode] = self.nodes.get(key)
+        if node is None:
+            node = self.nodes[key] = ForestNode(name, key, dot == len(children))
+            if dot > 0:
+                source: ForestNode = self._null_node(rule_id, name, children, dot - 1)
+                for child in self._null_nodes(children[dot - 1]):
+                    node.add_family(source, child)
+        return node
+
+    def _topological_order(self) -> List[ForestNode]:
+        "Nodes reachable from the roots, each one after all its children"
+        order: List[ForestNode] = []
+        done: Set[int] = set()
+        for root in self.roots:
+            if id(root) in done:
+                continue
+            on_stack: Set[int] = {id(root)}
+            stack: List[Tuple[ForestNode, Iterator[ForestNode]]] = [
+                (root, root.children())]
+            while stack:
+                node, children = stack[-1]
+                for child in children:
+                    if id(child) in on_stack:
+                        raise ValueError("Cyclic parse forest, infinitely many trees")
+                    if id(child) not in done:
+                        on_stack.add(id(child))
+                        stack.append((child, child.children()))
+                        break
+                else:
+                    stack.pop()
+                    on_stack.remove(id(node))
+                    done.add(id(node))
+                    order.append(node)
+        return order
+
+    def fold(self,
+             leaf: Callable[[str], T],
+             empty: U,
+             extend: Callable[[U, T], U],
+             complete: Callable[[str, U], T],
+             merge: Callable[[List[U]], U]) -> List[T]:
+        """
+        Evaluate all parses bottom-up, once per node. Rules are evaluated from
+        empty, extending it with the value of each child in turn (leaf for
+        lexemes), then complete turns it into the value of the rule.
+        Alternative derivations of a node are combined with merge.
+        Returns the value of each root.
+        """
+        partials: Dict[int, U] = {}
+        values: Dict[int, T] = {}
+
+        def value(child: ForestChild) -> T:
+            if isinstance(child, ForestNode):
+                return values[id(child)]
+            return leaf(child)
+
+        for node in self.order:
+            partial: U = empty
+            if node.families:
+                partial = merge([extend(partials[id(source)], value(child))
+                                 for source, child in node.families])
+            partials[id(node)] = partial
+            if node.complete:
+                values[id(node)] = complete(node.name, partial)
+        return [values[id(root)] for root in self.roots]
+
+    def count_trees(self) -> int:
+        "Number of parse trees, without enumerating them"
+        return sum(self.fold(leaf=lambda lexeme: 1,
+                             empty=1,
+                             extend=lambda count, child: count * child,
+                             complete=lambda rule, count: count,
+                             merge=sum))
+
+    def trees(self) -> Iterator[Tuple[str, List[ASTNode]]]:
+        "Lazily enumerate all parse trees"
+        for root in self.roots:
+            # Odometer over the nodes with alternatives met building a tree.
+            # Choices past the last one incremented start over from 0.
+            choices: List[int] = []
+            while True:
+                alternatives: List[int] = []
+                yield self._build_tree(root, choices, alternatives)
+                while choices and choices[-1] + 1 == alternatives[len(choices) - 1]:
+                    choices.pop()
+                if not choices:
+                    break
+                choices[-1] += 1
+
+    @staticmethod
+    def _build_tree(root: ForestNode, choices: List[int],
+                    alternatives: List[int]) -> Tuple[str, List[ASTNode]]:
+        "Build the tree picked by choices, appending 0 for new choice points"
+        tree: Tuple[str, List[ASTNode]] = (root.name, [])
+        pending: List[Tuple[ForestNode, List[ASTNode]]] = [(root, tree[1])]
+        while pending:
+            node, out = pending.pop()
+            # Walk back to the start of the rule collecting its children
+            collected: List[ForestChild] = []
+            while node.families:
+                choice: int = 0
+                if len(node.families) > 1:
+                    if len(alternatives) == len(choices):
+                        choices.append(0)
+                    choice = choices[len(alternatives)]
+                    alternatives.append(len(node.families))
+                node, child = node.families[choice]
+                collected.append(child)
+            for child in reversed(collected):
+                if isinstance(child, ForestNode):
+                    subtree: Tuple[str, List[ASTNode]] = (child.name, [])
+                    out.append(subtree)
+                    pending.append((child, subtree[1]))
+                else:
+                    out.append(child)
+        return tree
 
 
 class ForestIterator(Iterable[ASTNode]):
-    # Each item is the root of binary trees to be extracted first-depth.
-    # Each item branches to the left on Source, to the right on Trigger.
-    # That's the easy, non-ambiguous grammar case. Alternatively...
-    # There's a 3rd dimension for each item. Multiple back-pointers could
-    # be leading to each item. Which implies a partially overlapping tree.
+    "Iterate over all the parse trees, see ParseForest"
     def __init__(self, parser_output: Set[Item]) -> None:
-        self.items: Set[Item] = parser_output
-        self.gens: List[Tuple[Item, Iterator[List[ASTNode]]]] = []
+        self.forest: ParseForest = ParseForest(parser_output)
+        self.trees: Iterator[Tuple[str, List[ASTNode]]] = iter(())
 
     def __iter__(self) -> Iterator[ASTNode]:
-        self.gens = [(root, ForestIterator._trace_item(root))
-                     for root in self.items]
+        self.trees = self.forest.trees()
         return self
 
-    @staticmethod
-    def _trace_item(item: Item) -> Generator[List[ASTNode], None, None]:
-        # Base case, item has no source. Its the begining.
-        if len(item.backpointers) == 0:
-            yield []
-
-        for source, trigger in item.backpointers:
-            assert isinstance(source, Item), "BUG: Expected Item for source"
-            for spec_prefix in ForestIterator._trace_item(source):
-                if isinstance(trigger, Item):  # Backpointer is a Completion
-                    # Eg: source: (E -> E + . E), trigger: (E -> n .) => (E -> E + E .)
-                    for spec_suffix in ForestIterator._trace_item(trigger):
-                        yield spec_prefix + [(str(trigger.rule), spec_suffix)]
-                else:  # Backpointer is a Scan
-                    # Eg: source: (E -> E . + E), trigger: '+' => (E -> E + . E)
-                    assert isinstance(trigger, str)
-                    yield spec_prefix + [trigger]
-
     def __next__(self) -> Tuple[str, List[ASTNode]]:
-        if len(self.gens) == 0:
-            raise StopIteration
-        try:
-            root, tree_generator = self.gens[0]
-            tree: List[ASTNode] = next(tree_generator)
-            return (str(root.rule), tree)
-        except StopIteration:
-            self.gens.pop(0)
-            return self.__next__()
+        return next(self.trees)
 
 
 def extract_ast(parser_output: Set[Item]) -> Tuple[str, List[ASTNode]]:
-    # Each item is the root of binary trees to be extracted first-depth.
-    # Each item branches to the left on Source, to the right on Trigger.
-    # That's the easy, non-ambiguous grammar case.
+    # The easy, non-ambiguous grammar case.
     # Look at ForestIterator for ambiguous grammars
+    forest: ParseForest = ParseForest(parser_output)
+    assert forest.count_trees() == 1, "Ambiguous grammar, use ForestIterator"
+    return next(forest.trees())
+
+
+class FeedStatus(NamedTuple):
+    complete: bool  # input so far parses
+    viable: bool  # some more input could still be parsed
 
-    def _trace_item(item: Item) -> List[ASTNode]:
-        # Base case, item has no source. Its the begining.
-        if len(item.backpointers) == 0:
-            return []
 
-        assert len(item.backpointers) == 1, "Ambiguous, use ForestIterator"
-        source, trigger = next(iter(item.backpointers))
-        assert isinstance(source, Item), "BUG: Expected Item for source"
+class ParseError(RuntimeError):
+    "Input can't be parsed at position, the index of the offending token"
+    def __init__(self, position: int, token: Optional[str], expected: List[str]) -> None:
+        at: str = (f"token {position} {token!r}" if token is not None
+                   else f"end of input after {position} tokens")
+        wanted: str = ("one of " + ", ".join(expected)) if expected else "end of input"
+        super().__init__(f"Couldn't parse input at {at}, expected {wanted}")
+        self.position: int = position
+        self.token: Optional[str] = token  # None at the end of input
+        self.expected: List[str] = expected  # names of terminals that could parse
 
-        prefix: List[ASTNode] = _trace_item(source)
-        if isinstance(trigger, Item):  # Backpointer is a Completion
-            # Eg: source: (E -> E + . E), trigger: (E -> n .) => (E -> E + E .)
-            suffix: List[ASTNode] = _trace_item(trigger)
-            return prefix + [(str(trigger.rule), suffix)]
-        else:  # Backpointer is a Scan
-            # Eg: source: (E -> E . + E), trigger: '+' => (E -> E + . E)
-            assert isinstance(trigger, str)
-            return prefix + [trigger]
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (ParseError, (self.position, self.token, self.expected))
 
-    assert len(parser_output) == 1, "Ambiguous grammar, use ForestIterator"
-    root: Item = next(iter(parser_output))
-    return (str(root.rule), _trace_item(root))
 
+class EarleyParser:
+    """
+    Push-based parser, tokens are fed one at a time and parsed right away.
+    Feeding a token that can't be parsed raises ParseError and leaves the
+    parser as it was. With recover, such tokens are skipped instead and
+    recorded in skipped, so a parse of the rest of the input is still found.
+    With gc, StateSets that no item can complete back into anymore are
+    dropped, so memory stays bounded for grammars with limited lookback.
+    """
+    def __init__(self, grammar: Union[Grammar, CompiledGrammar],
+                 gc: bool = False, recover: bool = False) -> None:
+        # Compile once and pass a CompiledGrammar when parsing many inputs
+        self.grammar: CompiledGrammar = (
+            grammar if isinstance(grammar, CompiledGrammar) else grammar.compile())
+        self.gc: bool = gc
+        self.recover: bool = recover
+        # Tokens fed so far, and the index of those skipped to recover
+        self.tokens: int = 0
+        self.skipped: List[int] = []
+        # StateSets still in use by position in the input
+        self.statesets: Dict[int, StateSet] = {}
+        # With gc, positions of StateSets each one could complete back into
+        self.reachable: Dict[int, FrozenSet[int]] = {}
+        self.position: int = 0
 
-def parse(grammar: Grammar, input: Iterable[str]) -> Set[Item]:
+        # 0. populate StateSet-0: add items for rules matching start symbol
+        rules: List[Rule] = self.grammar.rules
+        self.statesets[0] = StateSet(
+            self.grammar, (Item.predict(rules[rule_id], rule_id, start=0)
+                           for rule_id in self.grammar.rules_by_head.get(
+                               self.grammar.start, [])))
+        self._process(0)
 
-    # 0. populate StateSet-0: add items for rules matching start symbol
-    s0 = StateSet({Item.predict(rule, start=0)
-                   for rule in grammar.rules(grammar.start)})
-    statesets: List[StateSet] = [s0]
+    def feed(self, lexeme: str) -> FeedStatus:
+        "Parse the next token"
+        # DEBUG: print(f"Lexeme: {lexeme}")
+        # Scan: populate next state with items that lexeme can advance
+        curstate: StateSet = self.statesets[self.position]
+        scanned: StateSet = StateSet(
+            self.grammar, (Item.scan(item, self.position + 1, lexeme)
+                           for item in curstate.scannable(self.grammar, lexeme)))
+        if len(scanned) == 0:
+            if not self.recover:
+                raise ParseError(self.tokens, lexeme, self.expected())
+            self.skipped.append(self.tokens)
+            self.tokens += 1
+            return self.status()
+        self.tokens += 1
+        self.position += 1
+        self.statesets[self.position] = scanned
+        self._process(self.position)
+        return self.status()
+
+    def expected(self) -> List[str]:
+        "Names of the terminals the next token could match"
+        next_symbol: List[Tuple[Optional[Symbol], ...]] = self.grammar.next_symbol
+        return sorted({next_symbol[item.rule_id][item.dot].name  # type: ignore
+                       for item in self.statesets[self.position].scanning})
+
+    def status(self) -> FeedStatus:
+        curstate: StateSet = self.statesets[self.position]
+        return FeedStatus(complete=any(self._is_result(item) for item in curstate),
+                          viable=len(curstate.scanning) > 0)
+
+    def results(self) -> Set[Item]:
+        "Items that parse all the input so far"
+        # Collect items from the last StateSet that have completed,
+        # span all input, and which their rule matches the grammar start symbol.
+        parsed_trees: Set[Item] = {
+            item for item in self.statesets[self.position] if self._is_result(item)}
+        if len(parsed_trees) == 0:
+            raise ParseError(self.tokens, None, self.expected())
+        return parsed_trees
 
-    # extract an iterator out of input
-    input = iter(input)
+    def partial_results(self) -> Set[Item]:
+        "Items that parse the longest prefix of the input possible, if any"
+        # Without gc all StateSets are kept, skipped tokens have none
+        for position in sorted(self.statesets, reverse=True):
+            parsed_trees: Set[Item] = {
+                item for item in self.statesets[position] if self._is_result(item)}
+            if parsed_trees:
+                return parsed_trees
+        return set()
 
-    for stateset_id in itertools.count():
+    def _is_result(self, item: Item) -> bool:
+        return (item.start == 0 and
+                item.is_complete() and
+                item.rule.head == self.grammar.start)
+
+    def _process(self, stateset_id: int) -> None:
+        "Run predictions and completions on a StateSet filled by scanning"
+        rules: List[Rule] = self.grammar.rules
+        predictions: Dict[str, FrozenSet[int]] = self.grammar.predictions
+        predicted_nonterms: Dict[str, FrozenSet[str]] = self.grammar.predicted_nonterms
+        next_symbol: List[Tuple[Optional[Symbol], ...]] = self.grammar.next_symbol
+        null_derivations: Dict[str, NullDerivation] = self.grammar.null_derivations
+        statesets: Dict[int, StateSet] = self.statesets
         curstate: StateSet = statesets[stateset_id]
         # DEBUG: print(f"StateSet[{stateset_id}]: {curstate}")
 
-        prev_item_count: Optional[int] = None
-        while len(curstate) != prev_item_count:
-            prev_item_count = len(curstate)
-
-            new_items: List[Item] = []
-            for trigger in curstate:
-                next_sym: Optional[Symbol] = trigger.next_symbol()
-                if next_sym and next_sym.is_nonterm():
-                    # Prediction: add rules starting with next symbol
-                    new_items.extend(
-                        Item.predict(rule, stateset_id)
-                        for rule in grammar.rules(next_sym.name))
-                elif next_sym is None and trigger.is_complete():
-                    # Completion: add items with rules that completed
-                    assert trigger.start <= stateset_id, "Item starts after end of stream"
-                    new_items.extend(
-                        Item.complete(src, trigger, stateset_id)
-                        for src in statesets[trigger.start]
-                        if trigger.can_complete(src))
-                else:
-                    # Scan: populate next state, ignored at this stage
-                    assert next_sym is not None and next_sym.is_terminal(), \
-                        "BUG: Expected Scan"
-
-            # DEBUG: print(f"New items: {new_items}")
-            # augment current stateset with new items, merging back-pointers
-            for newitem in new_items:
-                for existent in curstate:
-                    # Merge back-pointers into existing item
-                    if existent == newitem:
-                        existent.backpointers.update(newitem.backpointers)
-                        break
-                else:  # item is new
-                    curstate.add(newitem)
+        # Non-terminals already predicted in this set
+        predicted: Set[str] = set()
 
-        # Scan: populate next state with items that lexeme can advance
-        lexeme: Optional[str] = next(input, None)
-        if lexeme is None:
-            break
-        # DEBUG: print(f"Lexeme: {lexeme}")
-        statesets.append(
-            StateSet({Item.scan(item, stateset_id + 1, lexeme)
-                      for item in curstate if item.can_scan(lexeme)}))
+        # Items appended to curstate while walking it get processed in turn,
+        # each item is processed exactly once.
+        for trigger in curstate.items:
+            next_sym: Optional[Symbol] = next_symbol[trigger.rule_id][trigger.dot]
+            if next_sym is not None and next_sym.pred is None:
+                # Prediction: add the closure of rules next symbol predicts
+                if next_sym.name not in predicted:
+                    predicted.update(predicted_nonterms[next_sym.name])
+                    curstate.predict(rules, predictions[next_sym.name], stateset_id)
+                # Aycock-Horspool: if the symbol can derive the empty string
+                # advance over it right away instead of waiting for completion.
+                null_derivation: Optional[NullDerivation] = \
+                    null_derivations.get(next_sym.name)
+                if null_derivation is not None:
+                    curstate.add(Item.complete(trigger, null_derivation, stateset_id))
+            elif next_sym is None:
+                # Completion: add items with rules that completed
+                assert trigger.start <= stateset_id, "Item starts after end of stream"
+                # Empty completions were already handled on prediction
+                if trigger.start == stateset_id:
+                    continue
+                head: str = trigger.rule.head
+                # Leo: jump to the top of a deterministic right-recursive chain
+                path: Optional[LeoPath] = _leo_path(
+                    statesets, trigger.start, head, self.grammar.start)
+                if path is not None and path.up is not None:
+                    curstate.add(Item.complete(
+                        path.top, LeoTrigger(path, trigger, stateset_id), stateset_id))
+                    continue
+                for src in statesets[trigger.start].waiting.get(head, []):
+                    curstate.add(Item.complete(src, trigger, stateset_id))
+            else:
+                # Scan: populate next state, ignored at this stage
+                assert next_sym is not None and next_sym.is_terminal(), \
+                    "BUG: Expected Scan"
+
+        if self.gc:
+            self._collect(stateset_id)
 
-    # Collect items from the last StateSet that have completed,
-    # span all input, and which their rule matches the grammar start symbol.
-    parsed_trees: Set[Item] = {
-        item for item in iter(statesets[-1])
-        if item.start == 0 and
-        item.is_complete() and
-        item.rule.head == grammar.start}
+    def _collect(self, stateset_id: int) -> None:
+        "Drop StateSets that no future completion can reach"
+        curstate: StateSet = self.statesets[stateset_id]
+        # Completing an item goes back to the set it started in, and completing
+        # items waiting there further back to where those started.
+        reachable: Set[int] = {stateset_id}
+        for start in {item.start for waiting in curstate.waiting.values()
+                      for item in waiting}:
+            if start != stateset_id:
+                reachable.update(self.reachable[start])
+        self.reachable[stateset_id] = frozenset(reachable)
+        # Items yet to be completed, or scanned and completed later
+        live: Set[int] = {stateset_id}
+        for start in {item.start for item in curstate}:
+            live.update(self.reachable[start])
+        for dead in [position for position in self.statesets if position not in live]:
+            del self.statesets[dead]
+            del self.reachable[dead]
 
-    if len(parsed_trees) == 0:
-        raise RuntimeError("Couldn't parse input")
 
-    return parsed_trees
+def parse(grammar: Union[Grammar, CompiledGrammar], input: Iterable[str]) -> Set[Item]:
+    parser: EarleyParser = EarleyParser(grammar)
+    for lexeme in input:
+        parser.feed(lexeme)
+    return parser.results()
 
 
 class ParserTest(unittest.TestCase):
@@ -311,6 +888,297 @@ class ParserTest(unittest.TestCase):
         for tree in ForestIterator(trees):
             print(tree)
 
+    def test_long_input(self):
+        E = Symbol("E")
+        plus = Symbol('+', lambda x: x == '+')
+        n = Symbol('n', lambda x: x.isdigit())
+        grammar = Grammar("E", [
+            Rule('E', [n]),
+            Rule('E', [E, plus, n]),
+        ])
+        tokens: List[str] = list("+".join("7" * 150))
+        rule, children = extract_ast(parse(grammar, tokens))
+        self.assertEqual(rule, "E -> E + n")
+        self.assertEqual(children[1:], ['+', '7'])
+        depth: int = 1
+        while children[0] != '7':
+            depth += 1
+            rule, children = children[0]
+        self.assertEqual(depth, 150)
+
+    def test_right_recursion(self):
+        L = Symbol("L")
+        a = Symbol('a', lambda x: x == 'a')
+        comma = Symbol(',', lambda x: x == ',')
+        grammar = Grammar("L", [
+            Rule('L', [a, comma, L]),
+            Rule('L', [a]),
+        ])
+        tokens: List[str] = list(",".join("a" * 300))
+        parsed: Set[Item] = parse(grammar, tokens)
+        # The root is completed straight from the bottom of the chain
+        (source, trigger), = next(iter(parsed)).backpointers
+        self.assertIsInstance(trigger, LeoTrigger)
+        rule, children = extract_ast(parsed)
+        depth: int = 1
+        while len(children) == 3:
+            self.assertEqual(children[:2], ['a', ','])
+            depth += 1
+            rule, children = children[2]
+        self.assertEqual((rule, children), ("L -> a", ['a']))
+        self.assertEqual(depth, 300)
+
+    def test_forest(self):
+        S = Symbol("S")
+        b = Symbol('b', lambda x: x == 'b')
+        grammar = Grammar("S", [
+            Rule('S', [S, S]),
+            Rule('S', [b]),
+        ]).compile()
+        # Catalan numbers of binary trees
+        forest = ParseForest(parse(grammar, ['b'] * 7))
+        self.assertEqual(forest.count_trees(), 132)
+        self.assertEqual(len({repr(tree) for tree in forest.trees()}), 132)
+        forest = ParseForest(parse(grammar, ['b'] * 60))
+        self.assertEqual(forest.count_trees(), math.comb(118, 59) // 60)
+        # Deep trees don't hit the recursion limit
+        E = Symbol("E")
+        plus = Symbol('+', lambda x: x == '+')
+        n = Symbol('n', lambda x: x.isdigit())
+        grammar = Grammar("E", [
+            Rule('E', [n]),
+            Rule('E', [E, plus, n]),
+        ])
+        rule, children = extract_ast(parse(grammar, list("+".join("7" * 3000))))
+        self.assertEqual((rule, children[1:]), ("E -> E + n", ['+', '7']))
+
+    def test_fold(self):
+        E = Symbol("E")
+        plus = Symbol('+', lambda x: x == '+')
+        times = Symbol('*', lambda x: x == '*')
+        n = Symbol('n', lambda x: x.isdigit())
+        grammar = Grammar("E", [
+            Rule('E', [n]),
+            Rule('E', [E, plus, E]),
+            Rule('E', [E, times, E]),
+        ])
+        forest = ParseForest(parse(grammar, list("1+2*3+4")))
+        self.assertEqual(forest.count_trees(), 5)
+
+        # Values of all parses: partial values are the tuples of possible
+        # children values, values of nodes are sets of possible results
+        def evaluate(rule: str, partial: Set[Tuple[Any, ...]]) -> Set[Any]:
+            if rule == "E -> n":
+                return {int(digit) for digit, in partial}
+            if rule == "E -> E + E":
+                return {lhs + rhs for lhs, _, rhs in partial}
+            return {lhs * rhs for lhs, _, rhs in partial}
+
+        values = forest.fold(
+            leaf=lambda lexeme: {lexeme},
+            empty={()},
+            extend=lambda partial, child: {p + (c,) for p in partial for c in child},
+            complete=evaluate,
+            merge=lambda partials: set().union(*partials))
+        # One root per rule, E -> E + E and E -> E * E
+        self.assertEqual(set().union(*values), {11, 13, 15, 21})
+
+    def test_feed(self):
+        E = Symbol("E")
+        plus = Symbol('+', lambda x: x == '+')
+        n = Symbol('n', lambda x: x.isdigit())
+        grammar = Grammar("E", [
+            Rule('E', [n]),
+            Rule('E', [E, plus, n]),
+        ])
+        parser = EarleyParser(grammar)
+        self.assertEqual(parser.status(), FeedStatus(complete=False, viable=True))
+        self.assertEqual(parser.feed('1'), FeedStatus(complete=True, viable=True))
+        self.assertEqual(parser.feed('+'), FeedStatus(complete=False, viable=True))
+        self.assertEqual(parser.feed('2'), FeedStatus(complete=True, viable=True))
+        self.assertEqual(extract_ast(parser.results()),
+                         ('E -> E + n', [('E -> n', ['1']), '+', '2']))
+        self.assertRaises(ParseError, parser.feed, '3')
+        # A token that can't be parsed doesn't alter the parser
+        self.assertEqual(parser.status(), FeedStatus(complete=True, viable=True))
+        self.assertEqual(parser.feed('+'), FeedStatus(complete=False, viable=True))
+        self.assertRaises(RuntimeError, parser.results)
+
+    def test_parse_error(self):
+        E = Symbol("E")
+        plus = Symbol('+', lambda x: x == '+')
+        n = Symbol('n', lambda x: x.isdigit())
+        grammar = Grammar("E", [
+            Rule('E', [n]),
+            Rule('E', [E, plus, n]),
+        ]).compile()
+        # Fails on the first token that can't be parsed, the rest is unread
+        tokens: Iterator[str] = iter("1 + + 2 3".split())
+        with self.assertRaises(ParseError) as error:
+            parse(grammar, tokens)
+        self.assertEqual((error.exception.position, error.exception.token,
+                          error.exception.expected), (2, '+', ['n']))
+        self.assertEqual(list(tokens), ['2', '3'])
+        with self.assertRaises(ParseError) as error:
+            parse(grammar, "1 +".split())
+        self.assertEqual((error.exception.position, error.exception.token,
+                          error.exception.expected), (2, None, ['n']))
+        # Skip what can't be parsed
+        parser = EarleyParser(grammar, recover=True)
+        for token in "1 + x + 2 y + 3 +".split():
+            parser.feed(token)
+        self.assertEqual(parser.skipped, [2, 3, 5])
+        self.assertRaises(ParseError, parser.results)
+        self.assertEqual(extract_ast(parser.partial_results()),
+                         ('E -> E + n', [('E -> E + n', [('E -> n', ['1']), '+', '2']),
+                                         '+', '3']))
+
+    def test_feed_gc(self):
+        E = Symbol("E")
+        plus = Symbol('+', lambda x: x == '+')
+        n = Symbol('n', lambda x: x.isdigit())
+        grammar = Grammar("E", [
+            Rule('E', [n]),
+            Rule('E', [E, plus, n]),
+        ])
+        parser = EarleyParser(grammar, gc=True)
+        for lexeme in "+".join("7" * 1000):
+            parser.feed(lexeme)
+            # Left recursion only looks back to the start
+            self.assertLessEqual(len(parser.statesets), 3)
+        rule, children = extract_ast(parser.results())
+        self.assertEqual((rule, children[1:]), ("E -> E + n", ['+', '7']))
+        # Right recursion has to keep them all to complete the chain
+        L = Symbol("L")
+        a = Symbol('a', lambda x: x == 'a')
+        parser = EarleyParser(Grammar("L", [Rule('L', [a, L]), Rule('L', [a])]), gc=True)
+        for lexeme in "a" * 20:
+            parser.feed(lexeme)
+        self.assertEqual(len(parser.statesets), 21)
+        self.assertEqual(ParseForest(parser.results()).count_trees(), 1)
+
+    def test_terminal_index(self):
+        S = Symbol("S")
+        X = Symbol("X")
+        number = Symbol.regex("number", r"[0-9]+")
+        word = Symbol.regex("word", r"\w+")
+        ident = Symbol.regex("ident", r"[a-z]+")
+        grammar = Grammar("S", [
+            Rule('S', [Symbol.exact("let"), ident, Symbol.exact("="), X]),
+            Rule('X', [number]),
+            Rule('X', [word]),
+            Rule('X', [ident]),
+            # Predicates are still a fallback
+            Rule('X', [Symbol('odd', lambda x: x.isdigit() and int(x) % 2 == 1)]),
+        ]).compile()
+        self.assertEqual(grammar.pattern_ids, {r"[a-z]+": 0, r"[0-9]+": 1, r"\w+": 2})
+        self.assertEqual(grammar.matching_patterns("abc"), [0, 2])
+        self.assertEqual(grammar.matching_patterns("="), [])
+        # Overlapping terminals are all scanned
+        forest = ParseForest(parse(grammar, "let x = abc".split()))
+        self.assertEqual(forest.count_trees(), 2)
+        forest = ParseForest(parse(grammar, "let x = 13".split()))
+        self.assertEqual(
+            sorted(repr(tree) for tree in forest.trees()),
+            sorted(repr(('S -> let ident = X', ['let', 'x', '=', (rule, ['13'])]))
+                   for rule in ('X -> number', 'X -> word', 'X -> odd')))
+        self.assertRaises(RuntimeError, parse, grammar, "let 3 = 4".split())
+        # Patterns with flags, backreferences or the same group names work
+        grammar = Grammar("S", [
+            Rule('S', [Symbol.regex("kw", r"(?i)let"), X]),
+            Rule('X', [Symbol.regex("twice", r"(?P<c>.)(?P=c)")]),
+            Rule('X', [Symbol.regex("pair", r"(?P<c>.)\1")]),
+        ]).compile()
+        self.assertEqual(grammar.matching_patterns("aa"), [1, 2])
+        self.assertEqual(ParseForest(parse(grammar, ["LET", "zz"])).count_trees(), 2)
+        self.assertRaises(RuntimeError, parse, grammar, ["LET", "zy"])
+
+    def test_compile(self):
+        S = Symbol("S")
+        X = Symbol("X")
+        Y = Symbol("Y")
+        b = Symbol('b', lambda x: x == 'b')
+        grammar = Grammar("S", [
+            Rule('S', [S, S, X]),
+            Rule('X', []),
+            Rule('Y', [X, X]),
+            Rule('Y', [b]),
+            Rule('S', [b]),
+        ]).compile()
+        self.assertEqual(grammar.nullable, {"X", "Y"})
+        self.assertEqual(grammar.rules_by_head["S"], [0, 4])
+        self.assertEqual(grammar.next_symbol[0], (S, S, X, None))
+        self.assertEqual(grammar.rule_names[1], "X -> ")
+        # Predicting Y predicts the rules of X too
+        self.assertEqual(grammar.predicted_nonterms["Y"], {"X", "Y"})
+        self.assertEqual(grammar.predictions["Y"], {1, 2, 3})
+        self.assertEqual(grammar.predictions["S"], {0, 4})
+        # Repeated rules are merged, they don't make parses ambiguous
+        repeated = Grammar("S", [Rule('S', [b]), Rule('S', [S, b]), Rule('S', [b])])
+        self.assertEqual(repeated.compile().rule_names, ["S -> b", "S -> S b"])
+        self.assertEqual(ParseForest(parse(repeated, "b b".split())).count_trees(), 1)
+        # A compiled grammar can be reused across parses
+        self.assertEqual(len(parse(grammar, ["b"])), 1)
+        self.assertEqual(len(parse(grammar, "b b".split())), 1)
+
+    def test_nullable(self):
+        S = Symbol("S")
+        X = Symbol("X")
+        Y = Symbol("Y")
+        a = Symbol('a', lambda x: x == 'a')
+        c = Symbol('c', lambda x: x == 'c')
+        grammar = Grammar("S", [
+            Rule('S', [X, a, Y, X]),
+            Rule('X', [Y, Y]),
+            Rule('Y', []),
+            Rule('Y', [c]),
+        ])
+        empty_x = ('X -> Y Y', [('Y -> ', []), ('Y -> ', [])])
+        self.assertEqual(
+            extract_ast(parse(grammar, ['a'])),
+            ('S -> X a Y X', [empty_x, 'a', ('Y -> ', []), empty_x]))
+        # Both c could be the Y right after a or the first Y of the last X
+        trees = list(ForestIterator(parse(grammar, list("ac"))))
+        self.assertEqual(len(trees), 3)
+        # Whole input derives empty
+        grammar = Grammar("X", grammar.rules_)
+        self.assertEqual(extract_ast(parse(grammar, [])), empty_x)
+
+    def test_null_derivations_shared(self):
+        X = Symbol("X")
+        Y = Symbol("Y")
+        Z = Symbol("Z")
+        a = Symbol('a', lambda x: x == 'a')
+        # 2 ** 30 empty derivations of X, forest nodes are built once per rule
+        grammar = Grammar("S", [
+            Rule('S', [a, X]),
+            Rule('X', [Y] * 30),
+            Rule('Y', []),
+            Rule('Y', [Z]),
+            Rule('Z', []),
+        ]).compile()
+        self.assertEqual(
+            [name for _, name, _ in grammar.null_derivations["Y"].alternatives],
+            ["Y -> ", "Y -> Z"])
+        forest = ParseForest(parse(grammar, ['a']))
+        self.assertEqual(forest.count_trees(), 2 ** 30)
+        self.assertEqual(next(forest.trees()),
+                         ('S -> a X', ['a', ('X -> ' + ' '.join('Y' * 30),
+                                              [('Y -> ', [])] * 30)]))
+        # Rules closing a cycle of empty derivations are skipped
+        grammar = Grammar("S", [
+            Rule('S', [a, X]),
+            Rule('X', [Y]),
+            Rule('X', []),
+            Rule('Y', [X]),
+        ]).compile()
+        self.assertEqual(
+            [name for _, name, _ in grammar.null_derivations["X"].alternatives],
+            ["X -> "])
+        self.assertEqual(
+            sorted(map(repr, ForestIterator(parse(grammar, ['a'])))),
+            ["('S -> a X', ['a', ('X -> ', [])])"])
+
     def test_SSX_b(self):
         S = Symbol("S")
         X = Symbol("X")
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+# Parse a file of independent sentences, one per line, with an earl grammar
+# across a pool of processes. The grammar is given as module:attribute, where
+# the attribute is a Grammar, a CompiledGrammar or a function returning one.
+# Results are printed as JSON lines in input order:
+#   ./earl_batch.py mygrammars:arith sentences.txt > parsed.jsonl
+# Each line has either the AST, the number of parses if ambiguous, or the
+# position of the first token that couldn't be parsed and what was expected,
+# or the error that stopped the sentence from being parsed.
+
+import argparse
+import importlib
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import unittest
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import earl
+
+
+def load_grammar(spec: str) -> earl.CompiledGrammar:
+    "Import a grammar from a module:attribute spec"
+    module_name, _, attribute = spec.partition(":")
+    if not attribute:
+        raise ValueError(f"Expected module:attribute, got {spec!r}")
+    # Grammars usually live next to the sentences, not to this script
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    grammar: Any = getattr(importlib.import_module(module_name), attribute)
+    if callable(grammar) and not isinstance(grammar, (earl.Grammar, earl.CompiledGrammar)):
+        grammar = grammar()
+    if isinstance(grammar, earl.Grammar):
+        grammar = grammar.compile()
+    if not isinstance(grammar, earl.CompiledGrammar):
+        raise ValueError(f"{spec} is not a grammar")
+    return grammar
+
+
+TOKENIZERS: Dict[str, Callable[[str], List[str]]] = {
+    "whitespace": str.split,
+    "chars": lambda line: list(line.rstrip("\n")),
+}
+
+
+def parse_sentence(grammar: earl.CompiledGrammar, tokens: List[str]) -> Dict[str, Any]:
+    try:
+        forest = earl.ParseForest(earl.parse(grammar, tokens))
+        trees: int = forest.count_trees()
+    except earl.ParseError as error:
+        return {"ok": False, "position": error.position, "expected": error.expected}
+    except ValueError as error:  # eg: cyclic grammars have infinitely many trees
+        return {"ok": False, "error": str(error)}
+    if trees == 1:
+        return {"ok": True, "trees": 1, "ast": next(forest.trees())}
+    return {"ok": True, "trees": trees}
+
+
+# Set in each worker process by the pool initializer
+_worker_grammar: Optional[earl.CompiledGrammar] = None
+_worker_tokenize: Callable[[str], List[str]] = str.split
+
+
+def _init_worker(grammar_spec: str, tokenizer: str) -> None:
+    global _worker_grammar, _worker_tokenize
+    _worker_grammar = load_grammar(grammar_spec)
+    _worker_tokenize = TOKENIZERS[tokenizer]
+
+
+def encode_ast(ast: earl.ASTNode) -> str:
+    "JSON of an AST, as json.dumps would write it but without recursing"
+    out: List[str] = []
+    # Nodes to encode, or raw JSON punctuation to write as is
+    pending: List[Tuple[bool, Any]] = [(False, ast)]
+    while pending:
+        raw, node = pending.pop()
+        if raw:
+            out.append(node)
+        elif isinstance(node, str):
+            out.append(json.dumps(node))
+        else:
+            name, children = node
+            out.append(f"[{json.dumps(name)}, [")
+            pending.append((True, "]]"))
+            for position in range(len(children) - 1, -1, -1):
+                pending.append((False, children[position]))
+                if position > 0:
+                    pending.append((True, ", "))
+    return "".join(out)
+
+
+def encode_result(result: Dict[str, Any]) -> str:
+    "A result as a JSON line, ASTs can be too deep for json.dumps"
+    if "ast" not in result:
+        return json.dumps(result)
+    rest: Dict[str, Any] = {key: value for key, value in result.items() if key != "ast"}
+    return f'{json.dumps(rest)[:-1]}, "ast": {encode_ast(result["ast"])}}}'
+
+
+def _parse_line(numbered_line: Tuple[int, str]) -> Tuple[str, float]:
+    """
+    Parse a line in a worker, returns its JSON result and how long it took.
+    Results are encoded in the worker, deep ASTs can't be pickled back.
+    """
+    assert _worker_grammar is not None, "Worker not initialized"
+    line_number, line = numbered_line
+    start: float = time.perf_counter()
+    result: Dict[str, Any] = {"line": line_number}
+    try:
+        result.update(parse_sentence(_worker_grammar, _worker_tokenize(line)))
+        encoded: str = encode_result(result)
+    except Exception as error:  # a bad sentence shouldn't stop the batch
+        message: str = f"{type(error).__name__}: {error}"
+        encoded = json.dumps({"line": line_number, "ok": False, "error": message})
+    return encoded, time.perf_counter() - start
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    "Nearest-rank percentile"
+    if not sorted_values:
+        return float("nan")
+    rank: int = max(0, min(len(sorted_values) - 1,
+                           int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[rank]
+
+
+def report_latencies(latencies: List[float], elapsed: float) -> None:
+    latencies.sort()
+    print(f"{len(latencies)} sentences in {elapsed:.3f}s"
+          f" ({len(latencies) / elapsed if elapsed > 0 else float('inf'):.1f}/s)",
+          file=sys.stderr)
+    for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("max", 1.0)):
+        print(f"{name:>4} {percentile(latencies, fraction) * 1000:10.3f} ms",
+              file=sys.stderr)
+
+
+def parse_lines(lines: Iterable[str], grammar_spec: str, tokenizer: str,
+                processes: int, chunksize: int
+                ) -> Iterator[Tuple[str, float]]:
+    "JSON results of parsing each line, in input order"
+    numbered: Iterator[Tuple[int, str]] = enumerate(lines, start=1)
+    if processes == 1:
+        _init_worker(grammar_spec, tokenizer)
+        yield from map(_parse_line, numbered)
+        return
+    with multiprocessing.Pool(processes, _init_worker,
+                              (grammar_spec, tokenizer)) as pool:
+        yield from pool.imap(_parse_line, numbered, chunksize)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Parse sentences with earl")
+    parser.add_argument("grammar", help="module:attribute of the grammar")
+    parser.add_argument("input", nargs="?", help="one sentence per line, or stdin")
+    parser.add_argument("--tokenizer", choices=sorted(TOKENIZERS),
+                        default="whitespace", help="how to split lines into tokens")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--chunksize", type=int, default=64,
+                        help="lines sent to a worker at a time")
+    args = parser.parse_args()
+
+    latencies: List[float] = []
+    start: float = time.perf_counter()
+    with (open(args.input) if args.input else sys.stdin) as lines:
+        for result, latency in parse_lines(lines, args.grammar, args.tokenizer,
+                                           args.processes, args.chunksize):
+            latencies.append(latency)
+            print(result)
+    report_latencies(latencies, time.perf_counter() - start)
+
+
+# Grammars for EarlBatchTest, load_grammar imports them from a temporary module
+TEST_GRAMMARS = """
+from earl import Grammar, Rule, Symbol
+
+E, C = Symbol("E"), Symbol("C")
+plus, n = Symbol.exact("+"), Symbol.exact("n")
+left = Grammar("E", [Rule("E", [E, plus, n]), Rule("E", [n])])
+ambiguous = Grammar("E", [Rule("E", [E, plus, E]), Rule("E", [n])])
+
+def cyclic():
+    return Grammar("C", [Rule("C", [C]), Rule("C", [n])])
+"""
+
+
+class EarlBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        with open("batch_test_grammars.py", "w") as f:
+            f.write(TEST_GRAMMARS)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        sys.modules.pop("batch_test_grammars", None)
+        self.directory.cleanup()
+
+    def test_load_grammar(self):
+        self.assertIsInstance(load_grammar("batch_test_grammars:left"),
+                              earl.CompiledGrammar)
+        # functions returning a grammar are called
+        self.assertIsInstance(load_grammar("batch_test_grammars:cyclic"),
+                              earl.CompiledGrammar)
+        for spec in ("batch_test_grammars", "batch_test_grammars:plus"):
+            with self.assertRaises(ValueError):
+                load_grammar(spec)
+
+    def test_parse_sentence(self):
+        left = load_grammar("batch_test_grammars:left")
+        self.assertEqual(parse_sentence(left, ["n", "+", "n"]), {
+            "ok": True, "trees": 1,
+            "ast": ("E -> E + n", [("E -> n", ["n"]), "+", "n"])})
+        ambiguous = load_grammar("batch_test_grammars:ambiguous")
+        self.assertEqual(parse_sentence(ambiguous, "n + n + n".split()),
+                         {"ok": True, "trees": 2})
+        failure = parse_sentence(left, ["n", "n"])
+        self.assertEqual((failure["ok"], failure["position"]), (False, 1))
+        self.assertEqual(failure["expected"], ["+"])
+        cyclic = parse_sentence(load_grammar("batch_test_grammars:cyclic"), ["n"])
+        self.assertFalse(cyclic["ok"])
+        self.assertIn("Cyclic", cyclic["error"])
+
+    def test_parse_lines(self):
+        deep = "+".join("n" * 1500)
+        lines = ["n+n", "nn", deep, "n"] * 3
+        for processes in (1, 2):
+            encoded = [line for line, _ in parse_lines(
+                lines, "batch_test_grammars:left", "chars", processes, 2)]
+            # json.loads can't read the deep AST back either, check it as text
+            self.assertTrue(encoded[2].startswith(
+                '{"line": 3, "ok": true, "trees": 1, "ast": ["E -> E + n", '))
+            self.assertEqual(encoded[2].count('"E -> E + n"'), 1499)
+            self.assertEqual(encoded[2], encoded[6].replace('"line": 7', '"line": 3'))
+            results = [json.loads(line) for line in encoded if len(line) < 1000]
+            self.assertEqual([r["line"] for r in results],
+                             [1, 2, 4, 5, 6, 8, 9, 10, 12])
+            self.assertEqual([r["ok"] for r in results], [True, False, True] * 3)
+        cyclic = next(parse_lines(["n"], "batch_test_grammars:cyclic", "chars", 1, 1))
+        self.assertFalse(json.loads(cyclic[0])["ok"])
+
+    def test_encode_result(self):
+        result = {"line": 1, "ok": True, "trees": 1,
+                  "ast": ("S -> a \"b\"", ["a", ("X -> ", []), "\u00e9"])}
+        self.assertEqual(encode_result(result), json.dumps(result))
+        self.assertEqual(encode_result({"line": 2, "ok": False}),
+                         json.dumps({"line": 2, "ok": False}))
+
+    def test_percentile(self):
+        values = [1.0, 2.0, 3.0, 4.0]
+        self.assertEqual(percentile(values, 0.5), 2.0)
+        self.assertEqual(percentile(values, 0.9), 4.0)
+        self.assertEqual(percentile(values, 1.0), 4.0)
+        self.assertEqual(percentile(values, 0.0), 1.0)
+        self.assertEqual(percentile([7.0], 0.99), 7.0)
+        self.assertTrue(percentile([], 0.5) != percentile([], 0.5))  # nan
+
+
+if __name__ == "__main__":
+    main()
@@ -1,37 +1,498 @@
 #!/usr/bin/env python
 
+import abc
 from collections import Counter
+import copy
+import functools
+import io
 import itertools
+import json
 import math
+import multiprocessing
 import numpy as np
+import os
+import sys
+import tempfile
 from typing import (
     Any,
     Callable,
     Dict,
     Iterable,
+    Iterator,
     List,
     Optional,
+    Sequence,
     Tuple,
     Union,
 )
 import unittest
 
-# TODO: consier https://en.wikipedia.org/wiki/Kneser%E2%80%93Ney_smoothing
 
-class AdditiveSmoothingBigramEstimator:
+class NgramCounts:
+    """
+    Streaming unigram and bigram counter. Samples are consumed one at a time
+    so any iterator can be counted (eg: tokenized lines of a file) without
+    holding the corpus in memory. Counts feed the estimators' fromCounts.
+    """
+
+    def __init__(self) -> None:
+        self.unigrams: Counter = Counter()
+        self.bigrams: Counter = Counter()
+
+    def update(self, sample: Sequence[str]) -> None:
+        "Count unigrams and bigrams of a single sample"
+        self.unigrams.update(sample)
+        self.bigrams.update(zip(sample, itertools.islice(sample, 1, None)))
+
+    def consume(self, samples: Iterable[Sequence[str]]) -> "NgramCounts":
+        for sample in samples:
+            self.update(sample)
+        return self
+
+    @staticmethod
+    def fromFile(
+        lines: Iterable[str], tokenize: Callable[[str], List[str]] = str.split
+    ) -> "NgramCounts":
+        "Count a stream of text lines (eg: an open file), one sample per line"
+        return NgramCounts().consume(tokenize(line) for line in lines)
+
+
+def countNgrams(samples: Iterable[Sequence[str]]) -> Tuple[Counter, Counter]:
+    "Count unigrams and bigrams of all samples in a single pass"
+    counts: NgramCounts = NgramCounts().consume(samples)
+    return counts.unigrams, counts.bigrams
+
+
+def shards(samples: Iterable[Any], shardSize: int) -> Iterator[List[Any]]:
+    "Split a stream of samples in lists of at most shardSize elements"
+    samples = iter(samples)
+    while True:
+        shard: List[Any] = list(itertools.islice(samples, shardSize))
+        if len(shard) == 0:
+            return
+        yield shard
+
+
+def parallelCountNgrams(
+    samples: Iterable[Sequence[str]],
+    processes: Optional[int] = None,
+    shardSize: int = 10000,
+) -> Tuple[Counter, Counter]:
+    """
+    Count unigrams and bigrams with a pool of worker processes, each counting
+    one shard of samples at a time. Partial counts are merged by the parent,
+    so the result is the same as countNgrams(samples).
+    """
+    unigrams: Counter = Counter()
+    bigrams: Counter = Counter()
+    with multiprocessing.Pool(processes) as pool:
+        for shardUnigrams, shardBigrams in pool.imap(
+            countNgrams, shards(samples, shardSize)
+        ):
+            unigrams.update(shardUnigrams)
+            bigrams.update(shardBigrams)
+    return unigrams, bigrams
+
+
+class Vocabulary:
+    "Intern tokens as consecutive integer ids"
+
+    def __init__(self, tokens: Iterable[str] = ()) -> None:
+        self.tokens: List[str] = []
+        self.ids: Dict[str, int] = {}
+        for token in tokens:
+            self.add(token)
+
+    def add(self, token: str) -> int:
+        tokenId: Optional[int] = self.ids.get(token)
+        if tokenId is None:
+            tokenId = self.ids[token] = len(self.tokens)
+            self.tokens.append(token)
+        return tokenId
+
+    def id(self, token: Union[str, int]) -> Optional[int]:
+        "Map a token or an already interned id to its id, None if unknown"
+        if isinstance(token, (int, np.integer)):
+            return int(token) if 0 <= token < len(self.tokens) else None
+        return self.ids.get(token)
+
+    def __len__(self) -> int:
+        return len(self.tokens)
+
+    def __contains__(self, token: Union[str, int]) -> bool:
+        return self.id(token) is not None
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """
+        Flat form of the vocabulary, see MappedVocabulary: tokens as a UTF-8
+        blob, the offset where each one starts, and ids sorted by token.
+        """
+        encoded: List[bytes] = [token.encode() for token in self.tokens]
+        offsets: np.ndarray = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(token) for token in encoded], out=offsets[1:])
+        return {
+            "vocabularyData": np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            "vocabularyOffsets": offsets,
+            "vocabularyOrder": np.array(
+                sorted(range(len(encoded)), key=encoded.__getitem__), dtype=np.int64
+            ),
+        }
+
+
+class MappedVocabulary(Vocabulary):
+    """
+    Read-only Vocabulary over the arrays of Vocabulary.arrays, usually
+    memory-mapped, so loading it costs nothing. Tokens are found by binary
+    search over the sorted ids, tokens and ids are only built if used.
+    """
+
+    def __init__(
+        self, data: np.ndarray, offsets: np.ndarray, order: np.ndarray
+    ) -> None:
+        self.data = data
+        self.offsets = offsets
+        self.order = order
+
+    def _encoded(self, tokenId: int) -> bytes:
+        return self.data[self.offsets[tokenId] : self.offsets[tokenId + 1]].tobytes()
+
+    @functools.cached_property
+    def tokens(self) -> List[str]:  # type: ignore
+        return [self._encoded(i).decode() for i in range(len(self))]
+
+    @functools.cached_property
+    def ids(self) -> Dict[str, int]:  # type: ignore
+        return {token: tokenId for tokenId, token in enumerate(self.tokens)}
+
+    def add(self, token: str) -> int:
+        tokenId: Optional[int] = self.id(token)
+        if tokenId is None:
+            raise ValueError(f"Can't add {token!r} to a read-only vocabulary")
+        return tokenId
+
+    def id(self, token: Union[str, int]) -> Optional[int]:
+        if isinstance(token, (int, np.integer)):
+            return int(token) if 0 <= token < len(self) else None
+        if not isinstance(token, str):
+            return None
+        if "ids" in self.__dict__:  # already built for bulk lookups
+            return self.ids.get(token)
+        encoded: bytes = token.encode()
+        low, high = 0, len(self.order)
+        while low < high:
+            middle: int = (low + high) // 2
+            if self._encoded(self.order[middle]) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.order) and self._encoded(self.order[low]) == encoded:
+            return int(self.order[low])
+        return None
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+
+class UnigramTable:
+    """
+    Per-token values stored in a flat array indexed by Vocabulary id.
+    Supports the dict.get lookups the estimators do, by token or by id.
+    """
+
+    def __init__(self, vocabulary: Vocabulary, values: np.ndarray) -> None:
+        assert len(values) == len(vocabulary), "Need a value per token"
+        self.vocabulary = vocabulary
+        self.values = values
+
+    @staticmethod
+    def fromDict(vocabulary: Vocabulary, table: Dict[str, float]) -> "UnigramTable":
+        values: np.ndarray = np.zeros(
+            len(vocabulary), dtype=np.asarray(next(iter(table.values()), 0.0)).dtype
+        )
+        for token, value in table.items():
+            values[vocabulary.ids[token]] = value
+        return UnigramTable(vocabulary, values)
+
+    def get(self, token: Union[str, int], default: Any = None) -> Any:
+        tokenId: Optional[int] = self.vocabulary.id(token)
+        return default if tokenId is None else self.values[tokenId].item()
+
+    def __getitem__(self, token: Union[str, int]) -> Any:
+        tokenId: Optional[int] = self.vocabulary.id(token)
+        if tokenId is None:
+            raise KeyError(token)
+        return self.values[tokenId].item()
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.vocabulary.tokens)
+
+    def items(self) -> Iterator[Tuple[str, Any]]:
+        return zip(self.vocabulary.tokens, self.values.tolist())
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes
+
+
+class SparseBigramTable:
+    """
+    Bigram values in CSR layout (https://en.wikipedia.org/wiki/Sparse_matrix).
+    Successors of token x are indices[indptr[x]:indptr[x+1]] (sorted ids)
+    with their values aligned in values. Around 12 bytes per bigram instead of
+    a dict entry plus a tuple of two strings.
+    Lookups take (x, y) as tokens or Vocabulary ids.
+    """
+
+    def __init__(
+        self,
+        vocabulary: Vocabulary,
+        indptr: np.ndarray,
+        indices: np.ndarray,
+        values: np.ndarray,
+    ) -> None:
+        assert len(indptr) == len(vocabulary) + 1, "Need a row per token"
+        self.vocabulary = vocabulary
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+
+    @staticmethod
+    def fromDict(
+        vocabulary: Vocabulary, table: Dict[Tuple[str, str], Any]
+    ) -> "SparseBigramTable":
+        ids: Dict[str, int] = vocabulary.ids
+        rows: np.ndarray = np.fromiter(
+            (ids[x] for x, _ in table), dtype=np.int64, count=len(table)
+        )
+        cols: np.ndarray = np.fromiter(
+            (ids[y] for _, y in table), dtype=np.int32, count=len(table)
+        )
+        values: np.ndarray = np.array(list(table.values()))
+        order: np.ndarray = np.lexsort((cols, rows))
+        indptr: np.ndarray = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(vocabulary)), out=indptr[1:])
+        return SparseBigramTable(vocabulary, indptr, cols[order], values[order])
+
+    def _position(self, bigram: Tuple[Union[str, int], Union[str, int]]) -> int:
+        "Position of the bigram in indices/values, -1 if not stored"
+        x: Optional[int] = self.vocabulary.id(bigram[0])
+        y: Optional[int] = self.vocabulary.id(bigram[1])
+        if x is None or y is None:
+            return -1
+        lo, hi = int(self.indptr[x]), int(self.indptr[x + 1])
+        pos: int = lo + int(np.searchsorted(self.indices[lo:hi], y))
+        return pos if pos < hi and self.indices[pos] == y else -1
+
+    def get(
+        self, bigram: Tuple[Union[str, int], Union[str, int]], default: Any = None
+    ) -> Any:
+        pos: int = self._position(bigram)
+        return default if pos < 0 else self.values[pos].item()
+
+    def __getitem__(self, bigram: Tuple[Union[str, int], Union[str, int]]) -> Any:
+        pos: int = self._position(bigram)
+        if pos < 0:
+            raise KeyError(bigram)
+        return self.values[pos].item()
+
+    def __contains__(self, bigram: Tuple[Union[str, int], Union[str, int]]) -> bool:
+        return self._position(bigram) >= 0
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def rows(self) -> np.ndarray:
+        "Row (x id) of every stored bigram, aligned with indices and values"
+        return np.repeat(
+            np.arange(len(self.vocabulary), dtype=np.int64), np.diff(self.indptr)
+        )
+
+    def items(self) -> Iterator[Tuple[Tuple[str, str], Any]]:
+        tokens: List[str] = self.vocabulary.tokens
+        return (
+            ((tokens[x], tokens[y]), value)
+            for x, y, value in zip(
+                self.rows().tolist(), self.indices.tolist(), self.values.tolist()
+            )
+        )
+
+    @property
+    def nbytes(self) -> int:
+        return self.indptr.nbytes + self.indices.nbytes + self.values.nbytes
+
+
+# Model files: a directory holding model.json (model type, scalar parameters
+# and vocabularies) plus one .npy file per array. Arrays are loaded as
+# read-only np.memmap so processes loading the same model share the pages.
+MODEL_META_FILE = "model.json"
+
+
+def _saveModel(path: str, meta: Dict[str, Any], arrays: Dict[str, np.ndarray]) -> None:
+    os.makedirs(path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(path, f"{name}.npy"), np.ascontiguousarray(array))
+    with open(os.path.join(path, MODEL_META_FILE), "w") as f:
+        json.dump(dict(meta, arrays=sorted(arrays)), f)
+
+
+def _loadModel(path: str) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    with open(os.path.join(path, MODEL_META_FILE)) as f:
+        meta: Dict[str, Any] = json.load(f)
+    arrays: Dict[str, np.ndarray] = {
+        name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+        for name in meta["arrays"]
+    }
+    return meta, arrays
+
+
+def _loadModelOfType(
+    path: str, modelType: str
+) -> Tuple[Dict[str, Any], Dict[str, np.ndarray]]:
+    meta, arrays = _loadModel(path)
+    if meta["type"] != modelType:
+        raise ValueError(f"{path} holds a {meta['type']}, not a {modelType}")
+    return meta, arrays
+
+
+class BigramEstimator(abc.ABC):
+    """
+    Storage shared by the bigram estimators. Subclasses fit their tables in
+    _fit and list them by name so they can be compacted, saved and loaded:
+    - unigramTables: per-token dicts, the first one's keys are the vocabulary.
+    - bigramTables: per-bigram dicts over the same bigrams, the first one
+      decides whether the estimator was already compacted.
+    - scalars: float or int parameters, stored in model.json.
+    """
+
+    unigramTables: Tuple[str, ...] = ()
+    bigramTables: Tuple[str, ...] = ()
+    scalars: Tuple[str, ...] = ()
+
+    @abc.abstractmethod
+    def _fit(self, unigrams: Counter, bigrams: Counter, *args: Any) -> None:
+        "Fit the tables from counts, other arguments are the estimator's own"
+
+    @classmethod
+    def fromCounts(
+        cls, unigrams: Counter, bigrams: Counter, *args: Any, **kwargs: Any
+    ) -> Any:
+        """
+        Build the estimator from already counted unigrams and bigrams, other
+        arguments are the estimator's own (eg: discount)
+        """
+        estimator = cls.__new__(cls)
+        estimator._fit(unigrams, bigrams, *args, **kwargs)
+        return estimator
+
+    @classmethod
+    def fitParallel(
+        cls,
+        samples: Iterable[List[str]],
+        *args: Any,
+        processes: Optional[int] = None,
+        shardSize: int = 10000,
+        **kwargs: Any,
+    ) -> Any:
+        "Count samples in shards across worker processes, see parallelCountNgrams"
+        unigrams, bigrams = parallelCountNgrams(samples, processes, shardSize)
+        return cls.fromCounts(unigrams, bigrams, *args, **kwargs)
+
+    def compact(self) -> Any:
+        """
+        Switch to compact storage: tokens interned in a Vocabulary, unigram
+        tables as flat arrays and bigram tables in CSR arrays. pX/pXY then
+        also accept Vocabulary ids instead of tokens.
+        """
+        if isinstance(getattr(self, self.bigramTables[0]), SparseBigramTable):
+            return self
+        # Finalize cached tables and scalars while the counts are still dicts
+        unigramTables = {name: getattr(self, name) for name in self.unigramTables}
+        bigramTables = {name: getattr(self, name) for name in self.bigramTables}
+        for name in self.scalars:
+            getattr(self, name)
+        self.vocabulary = Vocabulary(unigramTables[self.unigramTables[0]])
+        # Tokens missing from a unigram table (eg: never a context) are stored as 0
+        for name, table in unigramTables.items():
+            setattr(self, name, UnigramTable.fromDict(self.vocabulary, table))
+        for name, table in bigramTables.items():
+            setattr(self, name, SparseBigramTable.fromDict(self.vocabulary, table))
+        return self
+
+    def seenUnigrams(self) -> Iterator[str]:
+        return (x for x, _ in getattr(self, self.unigramTables[0]).items())
+
+    def seenBigrams(self) -> Iterator[Tuple[str, str]]:
+        return (xy for xy, _ in getattr(self, self.bigramTables[0]).items())
+
+    def save(self, path: str) -> None:
+        "Save the compact form of the estimator to directory path"
+        est = copy.copy(self).compact()
+        bigrams: SparseBigramTable = getattr(est, self.bigramTables[0])
+        meta: Dict[str, Any] = {"type": type(self).__name__}
+        meta.update((name, getattr(est, name)) for name in self.scalars)
+        arrays: Dict[str, np.ndarray] = {
+            name: getattr(est, name).values
+            for name in self.unigramTables + self.bigramTables
+        }
+        arrays.update(indptr=bigrams.indptr, indices=bigrams.indices)
+        arrays.update(est.vocabulary.arrays())
+        _saveModel(path, meta, arrays)
+
+    @classmethod
+    def load(cls, path: str) -> Any:
+        """
+        Load a compact estimator saved in path, tables and vocabulary are
+        memory-mapped.
+        """
+        meta, arrays = _loadModelOfType(path, cls.__name__)
+        est = cls.__new__(cls)
+        for name in cls.scalars:
+            setattr(est, name, meta[name])
+        vocabulary: Vocabulary = MappedVocabulary(
+            arrays["vocabularyData"],
+            arrays["vocabularyOffsets"],
+            arrays["vocabularyOrder"],
+        )
+        est.vocabulary = vocabulary
+        for name in cls.unigramTables:
+            setattr(est, name, UnigramTable(vocabulary, arrays[name]))
+        indptr, indices = arrays["indptr"], arrays["indices"]
+        for name in cls.bigramTables:
+            setattr(
+                est, name, SparseBigramTable(vocabulary, indptr, indices, arrays[name])
+            )
+        return est
+
+
+class AdditiveSmoothingBigramEstimator(BigramEstimator):
     """
     BigramEstimator uses sample data to build probabilities of Unigram and Bigrams.
     - https://en.wikipedia.org/wiki/N-gram
     - Uses Additive smoothing (https://en.wikipedia.org/wiki/Additive_smoothing) to
       account for non-observed elements.
+    - samples are read in a single pass, so any iterator can be used.
+      Bigram probabilities are finalized on first use.
     """
 
+    unigramTables = ("unigramCounts", "pUnigram")
+    bigramTables = ("bigramCounts", "pBigram")
+    scalars = ("alpha", "uniques", "pUnigramDefault")
+
     def __init__(
         self, samples: Iterable[List[str]], uniqElements: Optional[int] = None
     ) -> None:
         """
         uniqElements may be provided if known, otherwise its estimated.
         """
+        unigrams, bigrams = countNgrams(samples)
+        self._fit(unigrams, bigrams, uniqElements)
+
+    def _fit(
+        self, unigrams: Counter, bigrams: Counter, uniqElements: Optional[int] = None
+    ) -> None:
         self.alpha: float = 1.0e-2
         self.pUnigram: Dict[str, float]
         self.pUnigramDefault: float
@@ -42,46 +503,48 @@ class AdditiveSmoothingBigramEstimator:
             self.pUnigramDefault,
             self.unigramCounts,
             self.uniques,
-        ) = self._unigrams(samples, self.alpha, uniqElements)
-        self.pBigram = self._bigrams(
-            samples, self.unigramCounts, self.alpha, self.uniques
+        ) = self._unigrams(unigrams, self.alpha, uniqElements)
+        self.bigramCounts: Counter = bigrams
+
+    @functools.cached_property
+    def pBigram(self) -> Dict[Tuple[str, str], float]:
+        return self._bigrams(
+            self.bigramCounts, self.unigramCounts, self.alpha, self.uniques
         )
 
     @staticmethod
     def _unigrams(
-        samples: Iterable[List[str]], alpha: float, uniqElements: Optional[int] = None
+        unigrams: Counter, alpha: float, uniqElements: Optional[int] = None
     ) -> Tuple[Dict[str, float], float, Counter, int]:
         """
-        Build unigram probabilities from sample data.
+        Build unigram probabilities from unigram counts.
         Use additive smoothing to assign some probability to unseen elements.
         """
-        unigrams: Counter = Counter(itertools.chain(*samples))
         # Additive smoothing: Assume we've seen all elements at least once
         # (times alpha) to assign non-0 probability to unseen elements.
         uniques: int = uniqElements if uniqElements else len(unigrams)
         totalCount: float = sum(unigrams.values()) + alpha * uniques
         # Estimate unigram probabilities
         pUnigram: Dict[str, float] = {
-            i: (unigrams[i] + alpha) / totalCount for i in unigrams.elements()
+            i: (count + alpha) / totalCount for i, count in unigrams.items()
         }
         pUnigramDefault: float = alpha / totalCount
         return pUnigram, pUnigramDefault, unigrams, uniques
 
     @staticmethod
     def _bigrams(
-        samples: Iterable[List[str]],
+        bigrams: Counter,
         unigramCounts: Counter,
         alpha: float,
         uniques: int,
     ) -> Dict[Tuple[str, str], float]:
         """
-        Build bigram probabilities from sample data.
+        Build bigram probabilities from bigram counts.
         Use additive smoothing to assign some probability to unseen elements.
         """
-        bigrams: Counter = Counter(itertools.chain(*[zip(s, s[1:]) for s in samples]))
         pBigram: Dict[Tuple[str, str], float] = {
-            (i, j): (bigrams[(i, j)] + alpha) / (unigramCounts[i] + alpha * uniques)
-            for i, j in bigrams.elements()
+            (i, j): (count + alpha) / (unigramCounts[i] + alpha * uniques)
+            for (i, j), count in bigrams.items()
         }
         return pBigram
 
@@ -102,18 +565,26 @@ class AdditiveSmoothingBigramEstimator:
         )
 
 
-class TuringGoodBigramEstimator:
+class TuringGoodBigramEstimator(BigramEstimator):
     """
     BigramEstimator uses sample data to build probabilities of Unigram and Bigrams.
+    - samples are read in a single pass, so any iterator can be used.
+      Bigram probabilities are finalized on first use.
     """
 
+    unigramTables = ("adjUnigrams",)
+    bigramTables = ("bigramCounts", "adjBigrams")
+    scalars = ("totalElems", "unseenUnigrams", "unseenBigrams")
+
     def __init__(self, samples: Iterable[List[str]]) -> None:
-        # Get count of unigrams
-        unigrams: Counter = Counter(itertools.chain(*samples))
+        self._fit(*countNgrams(samples))
+
+    def _fit(self, unigrams: Counter, bigrams: Counter) -> None:
         uniFreqFreq: Counter = Counter(unigrams.values())
         self.totalElems: int = sum(unigrams.values())
-        # Make sure we've got aligned data for log fitting
-        _ux, _uy = list(zip(*uniFreqFreq.items()))
+        # Make sure we've got aligned data for log fitting. Sorted so the fit
+        # doesn't depend on the order in which counts were merged.
+        _ux, _uy = list(zip(*sorted(uniFreqFreq.items())))
         uniFFLogFit: Callable[[float], float] = self.logFit(_ux, _uy)
         # Good-Turing redistribution of mass prob to allow for unseen events
         self.adjUnigrams: Dict[str, float] = {
@@ -126,26 +597,35 @@ class TuringGoodBigramEstimator:
             uniFreqFreq[1] != 0
         ), "Need to have seen some elements only once to estimate unseen"
         self.unseenUnigrams = uniFreqFreq.get(1, uniFFLogFit(1)) / self.totalElems
+        self.bigramCounts: Counter = bigrams
 
-        # Get count for bigrams
-        bigrams: Counter = Counter(itertools.chain(*[zip(s, s[1:]) for s in samples]))
+    @functools.cached_property
+    def _bigramFreqFreq(self) -> Tuple[Counter, Callable[[float], float]]:
         # Counts of all bigrams we've seen x times.
         # Eg: There's 1k different bigrams we've seen x times.
-        biFreqFreq: Counter = Counter(bigrams.values())
-        _bx, _by = list(zip(*biFreqFreq.items()))
-        biFFLogFit: Callable[[float], float] = self.logFit(_bx, _by)
+        biFreqFreq: Counter = Counter(self.bigramCounts.values())
+        _bx, _by = list(zip(*sorted(biFreqFreq.items())))
+        return biFreqFreq, self.logFit(_bx, _by)
+
+    @functools.cached_property
+    def adjBigrams(self) -> Dict[Tuple[str, str], float]:
+        biFreqFreq, biFFLogFit = self._bigramFreqFreq
         # Good-Turing redistribution of mass prob to allow for unseen events
-        self.adjBigrams: Dict[Tuple[str, str], float] = {
+        return {
             bigram: (count + 1)
             * biFreqFreq.get(count + 1, biFFLogFit(count + 1))
             / biFreqFreq.get(count, biFFLogFit(count))
-            for bigram, count in bigrams.items()
+            for bigram, count in self.bigramCounts.items()
         }
+
+    @functools.cached_property
+    def unseenBigrams(self) -> float:
+        biFreqFreq, biFFLogFit = self._bigramFreqFreq
         # Estimate unseen bigram count as (0+1) * N1/N
         assert (
             biFreqFreq[1] != 0
         ), "Need to have seen some elements only once to estimate unseen"
-        self.unseenBigrams = biFreqFreq.get(1, biFFLogFit(1)) / sum(bigrams.values())
+        return biFreqFreq.get(1, biFFLogFit(1)) / sum(self.bigramCounts.values())
 
     @staticmethod
     def logFit(
@@ -165,23 +645,212 @@ class TuringGoodBigramEstimator:
         return self.adjUnigrams.get(x, self.unseenUnigrams) / self.totalElems
 
 
+class KneserNeyBigramEstimator(BigramEstimator):
+    """
+    BigramEstimator using interpolated Kneser-Ney smoothing.
+    - https://en.wikipedia.org/wiki/Kneser%E2%80%93Ney_smoothing
+    - Bigram counts are discounted by d and the freed mass goes to the
+      continuation probability of y: how many different contexts precede it.
+    - The continuation distribution is interpolated with a uniform one over
+      seen elements plus one for unseen ones, so no probability is 0.
+    - Continuation probs and per-context interpolation weights are computed
+      at fit time so pXY is a couple of dict lookups.
+    """
+
+    unigramTables = ("unigramCounts", "contextCounts", "pContinuation", "interpolation")
+    bigramTables = ("bigramCounts", "pBigram")
+    scalars = ("discount", "pContinuationUnseen")
+
+    def __init__(
+        self, samples: Iterable[List[str]], discount: Optional[float] = None
+    ) -> None:
+        """
+        discount may be provided, otherwise its estimated as n1 / (n1 + 2 n2)
+        from the number of bigrams seen once (n1) and twice (n2). With too few
+        counts to estimate it (no n1 or no n2) it falls back to 0.75.
+        """
+        unigrams, bigrams = countNgrams(samples)
+        self._fit(unigrams, bigrams, discount)
+
+    def _fit(
+        self, unigrams: Counter, bigrams: Counter, discount: Optional[float] = None
+    ) -> None:
+        self.unigramCounts: Counter = unigrams
+        self.bigramCounts: Counter = bigrams
+        if discount is None:
+            freqFreq: Counter = Counter(bigrams.values())
+            n1, n2 = freqFreq[1], freqFreq[2]
+            # n1 / (n1 + 2 n2) is 1 without n2 and 0 without n1, both useless
+            discount = n1 / (n1 + 2 * n2) if n1 > 0 and n2 > 0 else 0.75
+        assert 0 < discount < 1, "Discount should be in (0, 1)"
+        self.discount: float = discount
+        # Count of each context c(x) = sum_y c(x, y), and of its distinct
+        # successors N1+(x.) and distinct predecessors N1+(.y) of each element.
+        contextCounts: Counter = Counter()
+        successors: Counter = Counter()
+        predecessors: Counter = Counter()
+        for (x, y), count in bigrams.items():
+            contextCounts[x] += count
+            successors[x] += 1
+            predecessors[y] += 1
+        self.contextCounts: Counter = contextCounts
+        # Continuation probability, interpolated with a uniform distribution
+        # over the seen elements plus an extra one that stands for all unseen.
+        distinctBigrams: int = max(len(bigrams), 1)
+        uniform: float = (
+            discount * len(predecessors) / distinctBigrams / (len(unigrams) + 1)
+            if len(bigrams) > 0
+            else 1.0 / (len(unigrams) + 1)
+        )
+        self.pContinuation: Dict[str, float] = {
+            y: max(predecessors[y] - discount, 0) / distinctBigrams + uniform
+            for y in unigrams
+        }
+        self.pContinuationUnseen: float = uniform
+        # Mass freed by discounting each context, assigned to pContinuation.
+        # Elements never seen as a context fall back to pContinuation.
+        self.interpolation: Dict[str, float] = {
+            x: discount * successors[x] / contextCounts[x]
+            if x in contextCounts
+            else 1.0
+            for x in unigrams
+        }
+
+    @functools.cached_property
+    def pBigram(self) -> Dict[Tuple[str, str], float]:
+        "Full interpolated p(y|x) for every seen bigram"
+        return {
+            (x, y): (count - self.discount) / self.contextCounts[x]
+            + self.interpolation[x] * self.pContinuation[y]
+            for (x, y), count in self.bigramCounts.items()
+        }
+
+    def pX(self, x: str) -> float:
+        "Return the continuation probability of x"
+        return self.pContinuation.get(x, self.pContinuationUnseen)
+
+    def pXY(self, x: str, y: str) -> float:
+        "Return p(y|x) = max(c(x,y) - d, 0)/c(x) + lambda(x) * pContinuation(y)"
+        return self.pBigram.get(
+            (x, y),
+            self.interpolation.get(x, 1.0)
+            * self.pContinuation.get(y, self.pContinuationUnseen),
+        )
+
+
 class MarkovChain:
     "1st Order Markov Chain"
 
     def __init__(
         self,
-        pEstimator: Union[AdditiveSmoothingBigramEstimator, TuringGoodBigramEstimator],
+        pEstimator: BigramEstimator,
     ) -> None:
         self.pEstimator = pEstimator
 
     def pSequence(self, sequence: List[str]) -> float:
         "Calculate the probability of this sequence of events"
+        return math.exp(self.logpSequence(sequence))
+
+    def logpSequence(self, sequence: List[str]) -> float:
+        "Calculate the log-probability of this sequence, doesn't underflow"
         if len(sequence) == 0:
-            return 0.0
-        logProb: float = math.log(self.pEstimator.pX(sequence[0])) + sum(
+            return -math.inf
+        return math.log(self.pEstimator.pX(sequence[0])) + sum(
             math.log(self.pEstimator.pXY(x, y)) for x, y in zip(sequence, sequence[1:])
         )
-        return math.exp(logProb)
+
+    @functools.cached_property
+    def _scoringIndex(self) -> Tuple[Any, ...]:
+        """
+        Log-probability arrays for logpSequences, built once from the estimator.
+        Tokens map to ids, id len(vocabulary) stands for any unseen token.
+        Compact estimators share their Vocabulary so their ids are accepted.
+        - logpX[x]
+        - bigramKeys: sorted x * (V + 1) + y for seen bigrams, bigramLogp aligned
+        - unseen bigrams: logpXY = rowLogp[x] + colLogp[y]. All estimators smooth
+          unseen bigrams as a product of a factor for x and one for y.
+        """
+        unseen: object = object()  # never equal to a token
+        est = self.pEstimator
+        vocabulary: Optional[Vocabulary] = getattr(est, "vocabulary", None)
+        if vocabulary is None:
+            vocabulary = Vocabulary(est.seenUnigrams())
+        tokens: List[Any] = vocabulary.tokens + [unseen]
+        stride: int = len(tokens)
+        logpX: np.ndarray = np.log([est.pX(x) for x in tokens])
+        rowLogp: np.ndarray = np.log([est.pXY(x, unseen) for x in tokens])
+        colLogp: np.ndarray = np.log([est.pXY(unseen, y) for y in tokens]) - rowLogp[-1]
+        bigrams: List[Tuple[str, str]] = list(est.seenBigrams())
+        keys: np.ndarray = np.fromiter(
+            (vocabulary.ids[x] * stride + vocabulary.ids[y] for x, y in bigrams),
+            dtype=np.int64,
+            count=len(bigrams),
+        )
+        order: np.ndarray = np.argsort(keys)
+        bigramLogp: np.ndarray = np.log([est.pXY(x, y) for x, y in bigrams])
+        return (
+            vocabulary,
+            logpX,
+            keys[order],
+            bigramLogp[order],
+            rowLogp,
+            colLogp,
+        )
+
+    def logpSequences(
+        self, sequences: Iterable[Sequence[Union[str, int]]]
+    ) -> np.ndarray:
+        """
+        Log-probability of each sequence in a batch. Tokens are mapped to ids
+        and transition log-probs are gathered for all sequences at once.
+        With a compact estimator tokens may also be its Vocabulary ids.
+        Empty sequences get -inf (probability 0 as in pSequence).
+        """
+        vocabulary, logpX, bigramKeys, bigramLogp, rowLogp, colLogp = self._scoringIndex
+        ids: Dict[str, int] = vocabulary.ids
+        acceptsIds: bool = vocabulary is getattr(self.pEstimator, "vocabulary", None)
+        unseen: int = len(logpX) - 1
+
+        def tokenId(x: Union[str, int]) -> int:
+            if isinstance(x, str):
+                return ids.get(x, unseen)
+            if not acceptsIds:
+                raise TypeError(f"Token ids need a compact estimator, got {x!r}")
+            xId: Optional[int] = vocabulary.id(x)
+            return unseen if xId is None else xId
+
+        lengths: List[int] = []
+        flat: List[int] = []
+        for sequence in sequences:
+            lengths.append(len(sequence))
+            flat.extend(map(tokenId, sequence))
+        tokens: np.ndarray = np.array(flat, dtype=np.int64)
+        counts: np.ndarray = np.array(lengths, dtype=np.int64)
+        starts: np.ndarray = np.cumsum(counts) - counts
+        nonEmpty: np.ndarray = counts > 0
+        logp: np.ndarray = np.full(len(counts), -np.inf)
+        logp[nonEmpty] = logpX[tokens[starts[nonEmpty]]]
+        # Transitions: consecutive tokens that belong to the same sequence
+        sequenceOf: np.ndarray = np.repeat(np.arange(len(counts)), counts)
+        sameSequence: np.ndarray = sequenceOf[:-1] == sequenceOf[1:]
+        x: np.ndarray = tokens[:-1][sameSequence]
+        y: np.ndarray = tokens[1:][sameSequence]
+        keys: np.ndarray = x * len(logpX) + y
+        pos: np.ndarray = np.minimum(
+            np.searchsorted(bigramKeys, keys), max(len(bigramKeys) - 1, 0)
+        )
+        seen: np.ndarray = (
+            bigramKeys[pos] == keys if len(bigramKeys) else np.zeros(len(keys), bool)
+        )
+        transitions: np.ndarray = np.where(
+            seen,
+            bigramLogp[pos] if len(bigramKeys) else 0.0,
+            rowLogp[x] + colLogp[y],
+        )
+        logp[nonEmpty] += np.bincount(
+            sequenceOf[:-1][sameSequence], weights=transitions, minlength=len(counts)
+        )[nonEmpty]
+        return logp
 
 
 class MarkovChainTest(unittest.TestCase):
@@ -202,6 +871,42 @@ class MarkovChainTest(unittest.TestCase):
         print(f'pSequence("ta") = {mc.pSequence(list("ta"))}')
         self.assertTrue(True)
 
+    def test_logpSequences(self):
+        samples: List[List[str]] = [
+            list("accgcgctta"),
+            list("gcttagtgac"),
+            list("tagccgttac"),
+            list("q"),
+        ]
+        candidates: List[str] = ["cggt", "gctt", "qact", "", "t", "ta", "zzxq"]
+        candidates.append("gattaca" * 200)  # would underflow in pSequence
+        for estimator in (
+            AdditiveSmoothingBigramEstimator(samples),
+            TuringGoodBigramEstimator(samples),
+            AdditiveSmoothingBigramEstimator(samples).compact(),
+            KneserNeyBigramEstimator(samples),
+        ):
+            mc = MarkovChain(estimator)
+            batch = mc.logpSequences([list(c) for c in candidates])
+            self.assertEqual(batch.shape, (len(candidates),))
+            for c, logp in zip(candidates, batch):
+                self.assertAlmostEqual(logp, mc.logpSequence(list(c)))
+            self.assertEqual(batch[3], -math.inf)
+            self.assertTrue(math.isfinite(batch[-1]))
+            self.assertEqual(mc.pSequence(list(candidates[-1])), 0.0)
+        # Compact estimators also score sequences of Vocabulary ids
+        compact = KneserNeyBigramEstimator(samples).compact()
+        mc = MarkovChain(compact)
+        encoded = [[compact.vocabulary.ids[x] for x in "gcttag"], [10**6, 0]]
+        self.assertTrue(
+            np.array_equal(
+                mc.logpSequences(encoded), mc.logpSequences([list("gcttag"), ["z", 0]])
+            )
+        )
+        self.assertEqual(mc.logpSequences([[10**6, 0]])[0], mc.logpSequence(["z", 0]))
+        with self.assertRaises(TypeError):
+            MarkovChain(KneserNeyBigramEstimator(samples)).logpSequences([[0, 1]])
+
     def test_pSequenceGoodTuring(self):
         # Calculate some initial state probabilities (probability of any state)
         samples: List[List[str]] = [
@@ -220,6 +925,178 @@ class MarkovChainTest(unittest.TestCase):
         print(f'pSequence("ta") = {mc.pSequence(list("ta"))}')
         self.assertTrue(True)
 
+    def test_pSequenceKneserNey(self):
+        samples: List[List[str]] = [
+            list("accgcgctta"),
+            list("gcttagtgac"),
+            list("tagccgttac"),
+            list("q"),
+        ]
+        estimator = KneserNeyBigramEstimator(samples)
+        mc: MarkovChain = MarkovChain(estimator)
+        print(f'pSequence("cggt") = {mc.pSequence(list("cggt"))}')
+        print(f'pSequence("qact") = {mc.pSequence(list("qact"))}')
+        # p(.|x) adds up to 1 over all seen elements plus the unseen one
+        elements = sorted(estimator.unigramCounts)
+        for x in elements + ["unseen"]:
+            total = sum(estimator.pXY(x, y) for y in elements)
+            total += estimator.pXY(x, "unseen")
+            self.assertAlmostEqual(total, 1.0)
+        total = sum(estimator.pX(x) for x in elements) + estimator.pX("unseen")
+        self.assertAlmostEqual(total, 1.0)
+        # Smoothed estimates keep the ordering of raw counts in a context
+        self.assertGreater(estimator.pXY("c", "g"), estimator.pXY("c", "a"))
+        compact = KneserNeyBigramEstimator(samples).compact()
+        self.assertEqual(compact.pXY("t", "a"), estimator.pXY("t", "a"))
+        self.assertEqual(compact.pXY("z", "a"), estimator.pXY("z", "a"))
+        self.assertEqual(compact.pXY("q", "z"), estimator.pXY("q", "z"))
+
+    def test_kneserNeyDiscountFallback(self):
+        # Every bigram seen once (no n2) or twice (no n1)
+        for samples in ([list("abcd")], [list("aa"), list("aa")]):
+            estimator = KneserNeyBigramEstimator(samples)
+            self.assertEqual(estimator.discount, 0.75)
+            for x in sorted(estimator.unigramCounts) + ["unseen"]:
+                total = sum(estimator.pXY(x, y) for y in estimator.unigramCounts)
+                total += estimator.pXY(x, "unseen")
+                self.assertAlmostEqual(total, 1.0)
+
+    def test_save_load(self):
+        samples: List[List[str]] = [
+            list("accgcgctta"),
+            list("gcttagtgac"),
+            list("tagccgttac"),
+            list("q"),
+        ]
+        pairs = [(x, y) for x in "acgtqz" for y in "acgtqz"]
+        for estimator in (
+            AdditiveSmoothingBigramEstimator(samples),
+            TuringGoodBigramEstimator(samples),
+            KneserNeyBigramEstimator(samples),
+        ):
+            with tempfile.TemporaryDirectory() as path:
+                estimator.save(path)
+                loaded = loadModel(path)
+                self.assertIs(type(loaded), type(estimator))
+                self.assertIsInstance(loaded.bigramCounts.values, np.memmap)
+                self.assertEqual(
+                    [loaded.pXY(x, y) for x, y in pairs],
+                    [estimator.pXY(x, y) for x, y in pairs],
+                )
+                self.assertEqual(
+                    [loaded.pX(x) for x in "acgtqz"],
+                    [estimator.pX(x) for x in "acgtqz"],
+                )
+                # Saving doesn't switch the estimator to compact storage
+                self.assertIsInstance(estimator.bigramCounts, Counter)
+                self.assertAlmostEqual(
+                    MarkovChain(loaded).logpSequences([list("gattaca")])[0],
+                    MarkovChain(estimator).logpSequence(list("gattaca")),
+                )
+                # The vocabulary is mapped too, not rebuilt from model.json
+                self.assertIsInstance(loaded.vocabulary, MappedVocabulary)
+                self.assertIsInstance(loaded.vocabulary.data, np.memmap)
+                with open(os.path.join(path, MODEL_META_FILE)) as f:
+                    self.assertNotIn("vocabulary", json.load(f))
+            with tempfile.TemporaryDirectory() as path:
+                estimator.save(path)
+                with self.assertRaises(ValueError):
+                    Hmm.load(path)
+
+    def test_mappedVocabulary(self):
+        tokens = ["gc", "", "日本", "a", "ä", "g"]
+        vocabulary = Vocabulary(tokens)
+        arrays = vocabulary.arrays()
+        mapped = MappedVocabulary(
+            arrays["vocabularyData"],
+            arrays["vocabularyOffsets"],
+            arrays["vocabularyOrder"],
+        )
+        self.assertEqual(len(mapped), len(tokens))
+        for token in tokens + ["z", "日", "gca"]:
+            self.assertEqual(mapped.id(token), vocabulary.id(token))
+        self.assertEqual(mapped.id(5), 5)
+        self.assertIsNone(mapped.id(6))
+        self.assertEqual(mapped.tokens, tokens)
+        self.assertEqual(mapped.ids, vocabulary.ids)
+        with self.assertRaises(ValueError):
+            mapped.add("z")
+        arrays = Vocabulary().arrays()
+        empty = MappedVocabulary(
+            arrays["vocabularyData"],
+            arrays["vocabularyOffsets"],
+            arrays["vocabularyOrder"],
+        )
+        self.assertIsNone(empty.id("a"))
+
+    def test_fitParallel(self):
+        samples: List[List[str]] = [
+            list("accgcgctta"),
+            list("gcttagtgac"),
+            list("tagccgttac"),
+        ] * 7 + [list("qz")]  # need some odd unigram and bigram only seen once
+        serial = AdditiveSmoothingBigramEstimator(samples)
+        parallel = AdditiveSmoothingBigramEstimator.fitParallel(
+            samples, processes=2, shardSize=3
+        )
+        self.assertEqual(serial.pUnigram, parallel.pUnigram)
+        self.assertEqual(serial.pBigram, parallel.pBigram)
+        self.assertEqual(serial.pUnigramDefault, parallel.pUnigramDefault)
+        serialGT = TuringGoodBigramEstimator(samples)
+        parallelGT = TuringGoodBigramEstimator.fitParallel(
+            samples, processes=2, shardSize=5
+        )
+        self.assertEqual(serialGT.adjUnigrams, parallelGT.adjUnigrams)
+        self.assertEqual(serialGT.adjBigrams, parallelGT.adjBigrams)
+        self.assertEqual(serialGT.unseenBigrams, parallelGT.unseenBigrams)
+        # Estimator arguments are passed on to fromCounts
+        parallelKN = KneserNeyBigramEstimator.fitParallel(samples, 0.5, processes=2)
+        serialKN = KneserNeyBigramEstimator(samples, 0.5)
+        self.assertEqual(serialKN.pBigram, parallelKN.pBigram)
+
+    def test_streaming(self):
+        lines: List[str] = ["a c c g c g", "g c t t a g", "t a g c c g", "q"]
+        samples: List[List[str]] = [line.split() for line in lines]
+        fromList = AdditiveSmoothingBigramEstimator(samples)
+        # A generator can only be read once
+        fromGenerator = AdditiveSmoothingBigramEstimator(s for s in samples)
+        self.assertEqual(fromList.pBigram, fromGenerator.pBigram)
+        self.assertTrue(len(fromGenerator.pBigram) > 0)
+        counts = NgramCounts.fromFile(io.StringIO("\n".join(lines)))
+        fromFile = TuringGoodBigramEstimator.fromCounts(counts.unigrams, counts.bigrams)
+        fromGT = TuringGoodBigramEstimator(iter(samples))
+        self.assertEqual(fromFile.adjBigrams, fromGT.adjBigrams)
+        self.assertEqual(fromFile.pXY("c", "g"), fromGT.pXY("c", "g"))
+
+    def test_compact(self):
+        rng = np.random.default_rng(5)
+        tokens: List[str] = [f"w{i}" for i in range(300)]
+        samples: List[List[str]] = [
+            [tokens[i] for i in rng.integers(len(tokens), size=50)]
+            for _ in range(200)
+        ] + [["seen", "once"]]
+        for estimator in (
+            AdditiveSmoothingBigramEstimator(samples),
+            TuringGoodBigramEstimator(samples),
+        ):
+            pairs = [
+                (x, y) for x in tokens[:60] + ["unseen"] for y in tokens[:60] + ["?"]
+            ]
+            expectedX = [estimator.pX(x) for x, _ in pairs]
+            expectedXY = [estimator.pXY(x, y) for x, y in pairs]
+            bigrams = estimator.bigramCounts
+            dictBytes = sys.getsizeof(bigrams) + sum(
+                sys.getsizeof(k) + sys.getsizeof(k[0]) + sys.getsizeof(k[1])
+                for k in bigrams
+            )
+            compact = estimator.compact()
+            self.assertEqual([compact.pX(x) for x, _ in pairs], expectedX)
+            self.assertEqual([compact.pXY(x, y) for x, y in pairs], expectedXY)
+            ids = compact.vocabulary.ids
+            self.assertEqual(compact.pXY(ids["w3"], ids["w7"]), compact.pXY("w3", "w7"))
+            self.assertLess(compact.bigramCounts.nbytes * 10, dictBytes)
+            self.assertEqual(dict(compact.bigramCounts.items()), dict(bigrams))
+
 
 class Hmm:
     """
@@ -237,6 +1114,96 @@ class Hmm:
         self.stateTransitionProb = stateTransitionProb
         self.eventEmissionProb = eventEmissionProb
         self.states = sorted(startProb)
+        # Integer encoding of states and events for the array-backed decoder.
+        self.stateIds: Dict[str, int] = {s: i for i, s in enumerate(self.states)}
+        self.events: List[str] = sorted(
+            {ev for emissions in eventEmissionProb.values() for ev in emissions}
+        )
+        self.eventIds: Dict[str, int] = {ev: i for i, ev in enumerate(self.events)}
+        # Parameter matrices. Missing entries are impossible (0 prob, -inf log).
+        #  start[s], transition[k, s] = p(s|k), emission[s, ev] = p(ev|s)
+        self.start: np.ndarray = np.array(
+            [startProb[s] for s in self.states], dtype=np.float64
+        )
+        self.transition: np.ndarray = np.array(
+            [
+                [stateTransitionProb[k].get(s, 0.0) for s in self.states]
+                for k in self.states
+            ],
+            dtype=np.float64,
+        )
+        self.emission: np.ndarray = np.array(
+            [
+                [eventEmissionProb[s].get(ev, 0.0) for ev in self.events]
+                for s in self.states
+            ],
+            dtype=np.float64,
+        )
+        self.logStart: np.ndarray
+        self.logTransition: np.ndarray
+        self.logEmission: np.ndarray
+        self._updateLogParameters()
+
+    def _updateLogParameters(self) -> None:
+        "Refresh the log-space matrices used by the decoders"
+        with np.errstate(divide="ignore"):
+            self.logStart = np.log(self.start)
+            self.logTransition = np.log(self.transition)
+            self.logEmission = np.log(self.emission)
+
+    # Dict parameters are rebuilt from the arrays when missing, which is the
+    # case for loaded models and after re-estimation.
+    @functools.cached_property
+    def startProb(self) -> Dict[str, float]:
+        return dict(zip(self.states, self.start.tolist()))
+
+    @functools.cached_property
+    def stateTransitionProb(self) -> Dict[str, Dict[str, float]]:
+        return {
+            k: dict(zip(self.states, row))
+            for k, row in zip(self.states, self.transition.tolist())
+        }
+
+    @functools.cached_property
+    def eventEmissionProb(self) -> Dict[str, Dict[str, float]]:
+        return {
+            s: dict(zip(self.events, row))
+            for s, row in zip(self.states, self.emission.tolist())
+        }
+
+    def save(self, path: str) -> None:
+        "Save states, events and parameter matrices to directory path"
+        _saveModel(
+            path,
+            {"type": type(self).__name__, "states": self.states, "events": self.events},
+            {
+                "start": self.start,
+                "transition": self.transition,
+                "emission": self.emission,
+                "logStart": self.logStart,
+                "logTransition": self.logTransition,
+                "logEmission": self.logEmission,
+            },
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "Hmm":
+        "Load an Hmm saved in path, parameter matrices are memory-mapped"
+        meta, arrays = _loadModelOfType(path, cls.__name__)
+        hmm = cls.__new__(cls)
+        hmm.states = meta["states"]
+        hmm.stateIds = {s: i for i, s in enumerate(hmm.states)}
+        hmm.events = meta["events"]
+        hmm.eventIds = {ev: i for i, ev in enumerate(hmm.events)}
+        for name, array in arrays.items():
+            setattr(hmm, name, array)
+        return hmm
+
+    def encodeEvents(self, observedEvents: Iterable[str]) -> np.ndarray:
+        "Map observed events to their integer ids"
+        return np.fromiter(
+            (self.eventIds[ev] for ev in observedEvents), dtype=np.intp
+        )
 
     def viterbiDecode(self, observedEvents: List[str]):
         """
@@ -288,7 +1255,305 @@ class Hmm:
 
         return list(reversed(path))
 
+    def viterbiDecodeVectorized(self, observedEvents: List[str]) -> List[str]:
+        """
+        Same as viterbiDecode but array-backed. Each time step is a single
+        max/argmax over an SxS matrix of log-probabilities and backpointers
+        are kept in a (T, S) int array. Ties resolve to the lowest state, as
+        in viterbiDecode, so both return the same path.
+        """
+        events: np.ndarray = self.encodeEvents(observedEvents)
+        numStates: int = len(self.states)
+        backpointers: np.ndarray = np.zeros((len(events), numStates), dtype=np.intp)
+        logp: np.ndarray = self.logStart + self.logEmission[:, events[0]]
+        for ev_idx in range(1, len(events)):
+            # scores[k, s]: best path ending in 'k' then transitioning to 's'
+            scores: np.ndarray = (
+                logp[:, np.newaxis] + self.logTransition
+            ) + self.logEmission[np.newaxis, :, events[ev_idx]]
+            backpointers[ev_idx] = np.argmax(scores, axis=0)
+            logp = scores[backpointers[ev_idx], np.arange(numStates)]
+        # Trace back the most likely path.
+        state: int = int(np.argmax(logp))
+        path: List[int] = [state]
+        for ev_idx in range(len(events) - 1, 0, -1):
+            state = int(backpointers[ev_idx, state])
+            path.append(state)
+        return [self.states[s] for s in reversed(path)]
+
+    def viterbiDecodeBatch(
+        self, observedSequences: Iterable[List[str]]
+    ) -> List[Tuple[List[str], float]]:
+        """
+        Decode many sequences at once. Sequences are padded into a (B, T)
+        event matrix and each step is a max/argmax over a (B, S, S) tensor.
+        Padded steps carry scores over unchanged with identity backpointers,
+        so each result matches viterbiDecode on that sequence alone.
+        Returns (path, log-probability of path) for each sequence.
+        """
+        encoded: List[np.ndarray] = [self.encodeEvents(o) for o in observedSequences]
+        if len(encoded) == 0:
+            return []
+        lengths: np.ndarray = np.array([len(e) for e in encoded], dtype=np.intp)
+        assert lengths.min() > 0, "Can't decode empty sequences"
+        batch, steps, numStates = len(encoded), int(lengths.max()), len(self.states)
+        events: np.ndarray = np.zeros((batch, steps), dtype=np.intp)
+        for b, e in enumerate(encoded):
+            events[b, : len(e)] = e
+        mask: np.ndarray = np.arange(steps)[np.newaxis, :] < lengths[:, np.newaxis]
+        # (S, E) -> (E, S) so that emissions for a batch step gather as (B, S)
+        logEmissionT: np.ndarray = np.ascontiguousarray(self.logEmission.T)
+        identity: np.ndarray = np.arange(numStates)
+        backpointers: np.ndarray = np.empty((steps, batch, numStates), dtype=np.intp)
+        backpointers[0] = identity
+        logp: np.ndarray = self.logStart[np.newaxis, :] + logEmissionT[events[:, 0]]
+        for ev_idx in range(1, steps):
+            # scores[b, k, s]: best path for 'b' ending in 'k' then moving to 's'
+            scores: np.ndarray = (
+                logp[:, :, np.newaxis] + self.logTransition[np.newaxis, :, :]
+            ) + logEmissionT[events[:, ev_idx]][:, np.newaxis, :]
+            best: np.ndarray = np.argmax(scores, axis=1)
+            active: np.ndarray = mask[:, ev_idx]
+            backpointers[ev_idx] = np.where(active[:, np.newaxis], best, identity)
+            logp = np.where(
+                active[:, np.newaxis],
+                np.take_along_axis(scores, best[:, np.newaxis, :], axis=1)[:, 0, :],
+                logp,
+            )
+        # Trace back all paths together, padded steps map states to themselves.
+        state: np.ndarray = np.argmax(logp, axis=1)
+        pathLogp: np.ndarray = logp[np.arange(batch), state]
+        paths: np.ndarray = np.empty((batch, steps), dtype=np.intp)
+        paths[:, steps - 1] = state
+        for ev_idx in range(steps - 1, 0, -1):
+            state = backpointers[ev_idx, np.arange(batch), state]
+            paths[:, ev_idx - 1] = state
+        return [
+            ([self.states[s] for s in paths[b, : lengths[b]]], float(pathLogp[b]))
+            for b in range(batch)
+        ]
+
+    def forward(self, observedEvents: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Scaled forward pass (https://en.wikipedia.org/wiki/Forward_algorithm).
+        Returns (alpha, scales) where alpha[t] is p(state at t | events[:t+1])
+        and scales[t] = p(events[t] | events[:t]). Normalizing each step keeps
+        long sequences from underflowing: log p(events) = sum(log(scales)).
+        """
+        events: np.ndarray = self.encodeEvents(observedEvents)
+        alpha: np.ndarray = np.empty((len(events), len(self.states)))
+        scales: np.ndarray = np.empty(len(events))
+        prev: np.ndarray = self.start
+        for ev_idx, ev in enumerate(events):
+            a: np.ndarray = prev if ev_idx == 0 else prev @ self.transition
+            a = a * self.emission[:, ev]
+            scale: float = a.sum()
+            if scale == 0.0:
+                raise ValueError("Observed events are impossible under this model")
+            alpha[ev_idx], scales[ev_idx] = a / scale, scale
+            prev = alpha[ev_idx]
+        return alpha, scales
+
+    def backward(self, observedEvents: List[str], scales: np.ndarray) -> np.ndarray:
+        """
+        Scaled backward pass using the scales from forward. With this scaling
+        alpha[t] * beta[t] is directly the posterior of each state at t.
+        """
+        events: np.ndarray = self.encodeEvents(observedEvents)
+        beta: np.ndarray = np.empty((len(events), len(self.states)))
+        beta[-1] = 1.0
+        for ev_idx in range(len(events) - 2, -1, -1):
+            beta[ev_idx] = self.transition @ (
+                self.emission[:, events[ev_idx + 1]] * beta[ev_idx + 1]
+            ) / scales[ev_idx + 1]
+        return beta
+
+    def posterior(self, observedEvents: List[str]) -> np.ndarray:
+        "Return gamma[t, s]: probability of being in state s at t given all events"
+        alpha, scales = self.forward(observedEvents)
+        return alpha * self.backward(observedEvents, scales)
 
+    def logLikelihood(self, observedEvents: List[str]) -> float:
+        "log p(observedEvents) summed over all state paths"
+        _, scales = self.forward(observedEvents)
+        return float(np.log(scales).sum())
+
+    def expectedCounts(
+        self,
+        observedSequences: Iterable[List[str]],
+        processes: int = 1,
+        shardSize: int = 1000,
+    ) -> "HmmCounts":
+        """
+        E-step of Baum-Welch. Sequences are streamed one at a time, memory
+        only holds the (S,), (S, S) and (S, E) count accumulators.
+        Counts are collected per shard of shardSize sequences and shards are
+        summed in order. With processes > 1 shards are counted by a pool of
+        workers, giving the same result as the serial run.
+        """
+        total: HmmCounts = HmmCounts.zeros(len(self.states), len(self.events))
+        if processes == 1:
+            for counts in map(self._shardCounts, shards(observedSequences, shardSize)):
+                total = total + counts
+            return total
+        with multiprocessing.Pool(
+            processes, initializer=_initHmmWorker, initargs=(self,)
+        ) as pool:
+            for counts in pool.imap(
+                _hmmWorkerShardCounts, shards(observedSequences, shardSize)
+            ):
+                total = total + counts
+        return total
+
+    def _shardCounts(self, observedSequences: Iterable[List[str]]) -> "HmmCounts":
+        counts: HmmCounts = HmmCounts.zeros(len(self.states), len(self.events))
+        for observed in observedSequences:
+            if len(observed) == 0:
+                continue
+            events: np.ndarray = self.encodeEvents(observed)
+            alpha, scales = self.forward(observed)
+            beta: np.ndarray = self.backward(observed, scales)
+            gamma: np.ndarray = alpha * beta
+            counts.start += gamma[0]
+            # xi[t, k, s] summed over t: alpha[t, k] p(s|k) p(ev[t+1]|s) beta[t+1, s]
+            nextTerm: np.ndarray = (
+                self.emission[:, events[1:]].T * beta[1:] / scales[1:, np.newaxis]
+            )
+            counts.transition += (alpha[:-1].T @ nextTerm) * self.transition
+            np.add.at(counts.emission.T, events, gamma)
+            counts.logLikelihood += float(np.log(scales).sum())
+            counts.sequences += 1
+        return counts
+
+    def reestimate(self, counts: "HmmCounts") -> None:
+        """
+        M-step of Baum-Welch: replace parameters by normalized expected counts.
+        States never visited in the counts keep their previous distributions.
+        """
+
+        def normalize(expected: np.ndarray, previous: np.ndarray) -> np.ndarray:
+            totals: np.ndarray = expected.sum(axis=-1, keepdims=True)
+            with np.errstate(invalid="ignore", divide="ignore"):
+                return np.where(totals > 0, expected / totals, previous)
+
+        self.start = normalize(counts.start, self.start)
+        self.transition = normalize(counts.transition, self.transition)
+        self.emission = normalize(counts.emission, self.emission)
+        self._updateLogParameters()
+        for name in ("startProb", "stateTransitionProb", "eventEmissionProb"):
+            self.__dict__.pop(name, None)
+
+    def baumWelch(
+        self,
+        observedSequences: Iterable[List[str]],
+        iterations: int = 100,
+        tolerance: float = 1.0e-6,
+        processes: int = 1,
+    ) -> List[float]:
+        """
+        Fit parameters to the observed sequences with Baum-Welch
+        (https://en.wikipedia.org/wiki/Baum%E2%80%93Welch_algorithm).
+        observedSequences is re-iterated once per iteration, so it may be a
+        re-iterable stream (eg: an object reading from a file) instead of a list,
+        but not an iterator or generator, which would be exhausted after the
+        first iteration: those raise TypeError. A corpus without any events
+        leaves parameters as they are and returns no log-likelihoods.
+        Stops once the log-likelihood improves by less than tolerance.
+        With processes > 1 the E-step is spread over a pool of workers.
+        Returns the corpus log-likelihood before each re-estimation.
+        """
+        if iter(observedSequences) is observedSequences:
+            raise TypeError("observedSequences should be re-iterable, not an iterator")
+        history: List[float] = []
+        for _ in range(iterations):
+            counts: HmmCounts = self.expectedCounts(observedSequences, processes)
+            if counts.sequences == 0:
+                if history:
+                    raise TypeError("observedSequences was exhausted after one pass")
+                return history  # nothing to fit, parameters are left as they were
+            self.reestimate(counts)
+            history.append(counts.logLikelihood)
+            if len(history) > 1 and history[-1] - history[-2] < tolerance:
+                break
+        return history
+
+
+# Model used by the Hmm.expectedCounts pool workers, set once per process.
+_workerHmm: Optional[Hmm] = None
+
+
+def _initHmmWorker(hmm: Hmm) -> None:
+    global _workerHmm
+    _workerHmm = hmm
+
+
+def _hmmWorkerShardCounts(observedSequences: List[List[str]]) -> "HmmCounts":
+    assert _workerHmm is not None, "Worker wasn't initialized"
+    return _workerHmm._shardCounts(observedSequences)
+
+
+class HmmCounts:
+    "Expected counts collected on the E-step of Baum-Welch, they can be summed"
+
+    def __init__(
+        self,
+        start: np.ndarray,
+        transition: np.ndarray,
+        emission: np.ndarray,
+        logLikelihood: float = 0.0,
+        sequences: int = 0,
+    ) -> None:
+        self.start = start
+        self.transition = transition
+        self.emission = emission
+        self.logLikelihood = logLikelihood
+        self.sequences = sequences
+
+    @staticmethod
+    def zeros(numStates: int, numEvents: int) -> "HmmCounts":
+        return HmmCounts(
+            np.zeros(numStates),
+            np.zeros((numStates, numStates)),
+            np.zeros((numStates, numEvents)),
+        )
+
+    def __add__(self, other: "HmmCounts") -> "HmmCounts":
+        return HmmCounts(
+            self.start + other.start,
+            self.transition + other.transition,
+            self.emission + other.emission,
+            self.logLikelihood + other.logLikelihood,
+            self.sequences + other.sequences,
+        )
+
+
+def loadModel(path: str) -> Any:
+    "Load any estimator or Hmm saved with its save method"
+    meta, _ = _loadModel(path)
+    modelTypes: Dict[str, Any] = {
+        cls.__name__: cls
+        for cls in (
+            AdditiveSmoothingBigramEstimator,
+            TuringGoodBigramEstimator,
+            KneserNeyBigramEstimator,
+            Hmm,
+        )
+    }
+    return modelTypes[meta["type"]].load(path)
+
+
+def _randomHmm(rng: np.random.Generator, states: List[str], events: List[str]) -> Hmm:
+    "Hmm with random distributions, to compare decoders against each other"
+
+    def randomDist(keys: List[str]) -> Dict[str, float]:
+        p = rng.random(len(keys))
+        return dict(zip(keys, p / p.sum()))
+
+    return Hmm(
+        randomDist(states),
+        {s: randomDist(states) for s in states},
+        {s: randomDist(events) for s in states},
+    )
 
 
 class HmmTest(unittest.TestCase):
@@ -350,6 +1615,140 @@ class HmmTest(unittest.TestCase):
         print(f'viterbiDecode("GGCACTGAA") = {path}')
         self.assertEqual(path, list("HHHLLLLLL"))
 
+    def test_vectorized_matches_dicts(self):
+        rng = np.random.default_rng(7)
+        states, events = [f"s{i}" for i in range(12)], list("abcdefgh")
+        hmm = _randomHmm(rng, states, events)
+        for length in (1, 2, 17, 200):
+            observed = list(rng.choice(events, size=length))
+            self.assertEqual(
+                hmm.viterbiDecodeVectorized(observed), hmm.viterbiDecode(observed)
+            )
+
+    def test_batch_matches_single(self):
+        rng = np.random.default_rng(11)
+        states, events = [f"s{i}" for i in range(9)], list("wxyz")
+        hmm = _randomHmm(rng, states, events)
+        sequences = [list(rng.choice(events, size=n)) for n in (5, 1, 40, 13, 2)]
+        decoded = hmm.viterbiDecodeBatch(sequences)
+        self.assertEqual(len(decoded), len(sequences))
+        for observed, (path, logp) in zip(sequences, decoded):
+            self.assertEqual(path, hmm.viterbiDecode(observed))
+            # Score the decoded path independently
+            expected = math.log(hmm.startProb[path[0]]) + sum(
+                math.log(hmm.stateTransitionProb[k][s]) for k, s in zip(path, path[1:])
+            ) + sum(
+                math.log(hmm.eventEmissionProb[s][ev]) for s, ev in zip(path, observed)
+            )
+            self.assertAlmostEqual(logp, expected)
+        self.assertEqual(hmm.viterbiDecodeBatch([]), [])
+
+    def test_forward_backward(self):
+        start_p = {"Healthy": 0.6, "Fever": 0.4}
+        hidden_state_p = {
+            "Healthy": {"Healthy": 0.7, "Fever": 0.3},
+            "Fever": {"Healthy": 0.4, "Fever": 0.6},
+        }
+        event_p = {
+            "Healthy": {"normal": 0.5, "cold": 0.4, "dizzy": 0.1},
+            "Fever": {"normal": 0.1, "cold": 0.3, "dizzy": 0.6},
+        }
+        hmm = Hmm(start_p, hidden_state_p, event_p)
+        observed = ["normal", "cold", "dizzy"]
+        # Brute force over all state paths
+        paths: Dict[Tuple[str, ...], float] = {}
+        for path in itertools.product(hmm.states, repeat=len(observed)):
+            p = start_p[path[0]] * event_p[path[0]][observed[0]]
+            for (k, s), ev in zip(zip(path, path[1:]), observed[1:]):
+                p *= hidden_state_p[k][s] * event_p[s][ev]
+            paths[path] = p
+        total = sum(paths.values())
+        self.assertAlmostEqual(hmm.logLikelihood(observed), math.log(total))
+        gamma = hmm.posterior(observed)
+        for t in range(len(observed)):
+            for s in hmm.states:
+                marginal = sum(p for path, p in paths.items() if path[t] == s) / total
+                self.assertAlmostEqual(gamma[t, hmm.stateIds[s]], marginal)
+        # Scaling keeps very long sequences finite
+        longLogp = hmm.logLikelihood(observed * 5000)
+        self.assertTrue(math.isfinite(longLogp) and longLogp < -1000)
+
+    def test_baum_welch(self):
+        rng = np.random.default_rng(3)
+        start = np.array([0.8, 0.2])
+        transition = np.array([[0.9, 0.1], [0.2, 0.8]])
+        emission = np.array([[0.7, 0.2, 0.1], [0.1, 0.3, 0.6]])
+        corpus: List[List[str]] = []
+        for _ in range(50):
+            s, sample = rng.choice(2, p=start), []
+            for _ in range(30):
+                sample.append("abc"[rng.choice(3, p=emission[s])])
+                s = rng.choice(2, p=transition[s])
+            corpus.append(sample)
+        hmm = Hmm(
+            {"x": 0.5, "y": 0.5},
+            {"x": {"x": 0.6, "y": 0.4}, "y": {"x": 0.3, "y": 0.7}},
+            {"x": {"a": 0.4, "b": 0.3, "c": 0.3}, "y": {"a": 0.2, "b": 0.4, "c": 0.4}},
+        )
+        history = hmm.baumWelch(corpus, iterations=30)
+        # EM never decreases the likelihood
+        self.assertTrue(all(b >= a - 1e-9 for a, b in zip(history, history[1:])))
+        self.assertGreater(history[-1], history[0])
+        self.assertAlmostEqual(sum(hmm.startProb.values()), 1.0)
+        for row in hmm.emission:
+            self.assertAlmostEqual(row.sum(), 1.0)
+        self.assertAlmostEqual(hmm.stateTransitionProb["x"]["y"], hmm.transition[0, 1])
+        # Sharded E-step across processes matches the serial one exactly
+        serial = hmm.expectedCounts(corpus, shardSize=7)
+        parallel = hmm.expectedCounts(corpus, processes=2, shardSize=7)
+        self.assertTrue(np.array_equal(serial.transition, parallel.transition))
+        self.assertTrue(np.array_equal(serial.emission, parallel.emission))
+        self.assertEqual(serial.logLikelihood, parallel.logLikelihood)
+        self.assertEqual(parallel.sequences, len(corpus))
+        # Streams must be re-iterable, a generator would only feed one E-step
+        with self.assertRaises(TypeError):
+            hmm.baumWelch((sample for sample in corpus), iterations=2)
+
+        class OneShot:
+            def __init__(self):
+                self.samples = iter(corpus)
+
+            def __iter__(self):
+                return self.samples
+
+        with self.assertRaises(TypeError):
+            hmm.baumWelch(OneShot(), iterations=2)
+        # Nothing to fit in an empty corpus
+        transition = hmm.transition.copy()
+        self.assertEqual(hmm.baumWelch([]), [])
+        self.assertEqual(hmm.baumWelch([[]]), [])
+        self.assertTrue(np.array_equal(hmm.transition, transition))
+
+    def test_save_load(self):
+        hmm = Hmm(
+            {"H": 0.5, "L": 0.5},
+            {"H": {"H": 0.5, "L": 0.5}, "L": {"H": 0.4, "L": 0.6}},
+            {
+                "H": {"A": 0.2, "C": 0.3, "G": 0.3, "T": 0.2},
+                "L": {"A": 0.3, "C": 0.2, "G": 0.2, "T": 0.3},
+            },
+        )
+        with tempfile.TemporaryDirectory() as path:
+            hmm.save(path)
+            loaded = loadModel(path)
+            self.assertIsInstance(loaded.logTransition, np.memmap)
+            observed = list("GGCACTGAA")
+            self.assertEqual(loaded.viterbiDecode(observed), list("HHHLLLLLL"))
+            self.assertEqual(
+                loaded.viterbiDecodeVectorized(observed), list("HHHLLLLLL")
+            )
+            self.assertEqual(loaded.startProb, hmm.startProb)
+            self.assertAlmostEqual(
+                loaded.logLikelihood(observed), hmm.logLikelihood(observed)
+            )
+            # Training replaces the read-only mapped arrays
+            loaded.baumWelch([observed], iterations=2)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+# Benchmarks for hmm.py: estimator fitting, sequence scoring and decoding
+# on synthetic models and corpora. Results are saved as JSON and runs can be
+# compared against each other:
+#   ./hmm_bench.py --states 64 --output before.json
+#   ./hmm_bench.py --states 64 --output after.json --compare before.json
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+import hmm
+
+
+def randomDistributions(
+    rng: np.random.Generator, rows: int, columns: int
+) -> np.ndarray:
+    "rows x columns matrix of random distributions, skewed like real data"
+    weights: np.ndarray = rng.gamma(0.5, size=(rows, columns)) + 1.0e-6
+    return weights / weights.sum(axis=1, keepdims=True)
+
+
+def syntheticHmm(rng: np.random.Generator, states: int, events: int) -> hmm.Hmm:
+    stateNames: List[str] = [f"s{i}" for i in range(states)]
+    eventNames: List[str] = [f"e{i}" for i in range(events)]
+    start: np.ndarray = randomDistributions(rng, 1, states)[0]
+    transition: np.ndarray = randomDistributions(rng, states, states)
+    emission: np.ndarray = randomDistributions(rng, states, events)
+    return hmm.Hmm(
+        dict(zip(stateNames, start.tolist())),
+        {s: dict(zip(stateNames, p)) for s, p in zip(stateNames, transition.tolist())},
+        {s: dict(zip(eventNames, p)) for s, p in zip(stateNames, emission.tolist())},
+    )
+
+
+def sampleCorpus(
+    rng: np.random.Generator, model: hmm.Hmm, sequences: int, length: int
+) -> List[List[str]]:
+    "Walk the model to emit sequences, all sequences advance together"
+
+    def choose(cumulative: np.ndarray) -> np.ndarray:
+        return (rng.random(len(cumulative))[:, np.newaxis] < cumulative).argmax(axis=1)
+
+    cumTransition: np.ndarray = np.cumsum(model.transition, axis=1)
+    cumEmission: np.ndarray = np.cumsum(model.emission, axis=1)
+    state: np.ndarray = choose(np.tile(np.cumsum(model.start), (sequences, 1)))
+    emitted: np.ndarray = np.empty((sequences, length), dtype=np.intp)
+    for t in range(length):
+        emitted[:, t] = choose(cumEmission[state])
+        state = choose(cumTransition[state])
+    events: List[str] = model.events
+    return [[events[e] for e in row] for row in emitted.tolist()]
+
+
+def measure(
+    name: str, fn: Callable[[], Any], items: int, unit: str, repeat: int
+) -> Dict[str, Any]:
+    "Best wall time over repeat runs plus the peak traced memory of one run"
+    timings: List[float] = []
+    for _ in range(repeat):
+        start: float = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    best: float = min(timings)
+    result: Dict[str, Any] = {
+        "name": name,
+        "seconds": best,
+        "throughput": items / best if best > 0 else float("inf"),
+        "unit": unit,
+        "peakBytes": peak,
+    }
+    print(
+        f"{name:40} {best:10.4f}s {result['throughput']:14.1f} {unit}/s"
+        f" {peak / 2**20:10.1f} MiB",
+        file=sys.stderr,
+    )
+    return result
+
+
+def runBenchmarks(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    rng: np.random.Generator = np.random.default_rng(args.seed)
+    model: hmm.Hmm = syntheticHmm(rng, args.states, args.vocabulary)
+    corpus: List[List[str]] = sampleCorpus(rng, model, args.corpus, args.length)
+    tokens: int = args.corpus * args.length
+    # Good-Turing needs some unigram and bigram seen only once
+    fitCorpus: List[List[str]] = corpus + [["<rare>", "<once>"]]
+    results: List[Dict[str, Any]] = []
+
+    estimators: Tuple[Any, ...] = (
+        hmm.AdditiveSmoothingBigramEstimator,
+        hmm.TuringGoodBigramEstimator,
+        hmm.KneserNeyBigramEstimator,
+    )
+    for estimator in estimators:
+        results.append(
+            measure(
+                f"fit/{estimator.__name__}",
+                # Touch the bigram tables so lazy finalization is measured too
+                lambda: estimator(fitCorpus).pXY(corpus[0][0], corpus[0][1]),
+                tokens,
+                "tokens",
+                args.repeat,
+            )
+        )
+
+    chain = hmm.MarkovChain(hmm.KneserNeyBigramEstimator(fitCorpus))
+    chain.logpSequences(corpus[:1])  # build the scoring index once
+    results.append(
+        measure(
+            "score/logpSequence",
+            lambda: [chain.logpSequence(s) for s in corpus],
+            args.corpus,
+            "sequences",
+            args.repeat,
+        )
+    )
+    results.append(
+        measure(
+            "score/logpSequences",
+            lambda: chain.logpSequences(corpus),
+            args.corpus,
+            "sequences",
+            args.repeat,
+        )
+    )
+
+    decodeSet: List[List[str]] = corpus[: args.decode]
+    decodeTokens: int = sum(len(s) for s in decodeSet)
+    if args.states <= args.max_dict_states:
+        results.append(
+            measure(
+                "decode/viterbiDecode",
+                lambda: [model.viterbiDecode(s) for s in decodeSet],
+                decodeTokens,
+                "tokens",
+                args.repeat,
+            )
+        )
+    results.append(
+        measure(
+            "decode/viterbiDecodeVectorized",
+            lambda: [model.viterbiDecodeVectorized(s) for s in decodeSet],
+            decodeTokens,
+            "tokens",
+            args.repeat,
+        )
+    )
+    results.append(
+        measure(
+            "decode/viterbiDecodeBatch",
+            lambda: model.viterbiDecodeBatch(decodeSet),
+            decodeTokens,
+            "tokens",
+            args.repeat,
+        )
+    )
+    results.append(
+        measure(
+            "train/expectedCounts",
+            lambda: model.expectedCounts(decodeSet),
+            decodeTokens,
+            "tokens",
+            args.repeat,
+        )
+    )
+    return results
+
+
+def compare(results: List[Dict[str, Any]], baselinePath: str) -> None:
+    "Print the speedup of each benchmark against a previous run"
+    with open(baselinePath) as f:
+        baseline: Dict[str, Dict[str, Any]] = {
+            r["name"]: r for r in json.load(f)["results"]
+        }
+    print(f"\nCompared to {baselinePath}:", file=sys.stderr)
+    for result in results:
+        previous: Optional[Dict[str, Any]] = baseline.get(result["name"])
+        if previous is None:
+            continue
+        speedup: float = previous["seconds"] / result["seconds"]
+        memory: float = result["peakBytes"] / max(previous["peakBytes"], 1)
+        print(
+            f"{result['name']:40} {speedup:8.2f}x faster {memory:8.2f}x memory",
+            file=sys.stderr,
+        )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark hmm.py")
+    parser.add_argument("--states", type=int, default=16, help="hidden states")
+    parser.add_argument("--vocabulary", type=int, default=500, help="distinct events")
+    parser.add_argument("--length", type=int, default=200, help="sequence length")
+    parser.add_argument("--corpus", type=int, default=2000, help="sequences")
+    parser.add_argument(
+        "--decode", type=int, default=100, help="sequences to decode/train on"
+    )
+    parser.add_argument("--repeat", type=int, default=3, help="runs, best is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--max-dict-states",
+        type=int,
+        default=64,
+        help="skip the pure-python decoder above this many states",
+    )
+    parser.add_argument("--output", help="save results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    args = parser.parse_args()
+
+    results: List[Dict[str, Any]] = runBenchmarks(args)
+    report: Dict[str, Any] = {
+        "config": {
+            k: v for k, v in vars(args).items() if k not in ("output", "compare")
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+        },
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -2,31 +2,66 @@
 
 # http://norvig.com/lispy.html
 
+import operator
+import re
+import tempfile
+import unittest
+
 Symbol = str
 List = list
 Number = (int, float)
 
 
+# Parentheses, or runs of anything else that isn't blank
+TOKEN = re.compile(r"[()]|[^\s()]+")
+
+
 def tokenize(chars):
     "Convert input characters to a list of output tokens"
-    return chars.replace("(", " ( ").replace(")", " ) ").split()
+    return TOKEN.findall(chars)
+
+
+def tokenize_file(lines):
+    "Iterate over the tokens of a file, or any iterable of lines"
+    for line in lines:
+        yield from TOKEN.findall(line)
 
 
 def read_from_tokens(tokens):
-    "Build an expression from a token list "
-    if len(tokens) == 0:
+    """
+    Build the next expression from a token list, popping the tokens it reads,
+    or from a token iterator
+    """
+    if isinstance(tokens, list):
+        remaining = iter(tokens)
+        exp = read_from_tokens(remaining)
+        del tokens[: len(tokens) - operator.length_hint(remaining)]
+        return exp
+    for exp in read_all(tokens):
+        return exp
+    raise SyntaxError("unexpected EOF")
+
+
+def read_all(tokens):
+    "Build expressions from a token iterator, one per top level form"
+    # Lists being read, innermost last, so nesting doesn't recurse
+    stack = []
+    for token in tokens:
+        if "(" == token:
+            stack.append([])
+            continue
+        elif ")" == token:
+            if not stack:
+                raise SyntaxError("unexpected ')'")
+            exp = stack.pop()
+        else:
+            exp = atom(token)
+        if stack:
+            stack[-1].append(exp)
+        else:
+            yield exp
+    if stack:
         raise SyntaxError("unexpected EOF")
-    token = tokens.pop(0)
-    if "(" == token:
-        L = []
-        while tokens[0] != ")":
-            L.append(read_from_tokens(tokens))
-        tokens.pop(0)  # pop ')'
-        return L
-    elif ")" == token:
-        raise SyntaxError("unexpected ')'")
-    else:
-        return atom(token)
 
 
 def atom(token):
@@ -44,6 +79,17 @@ def parse(program):
     return read_from_tokens(tokenize(program))
 
 
+def parse_all(program):
+    "Iterate over all the expressions in program"
+    return read_all(tokenize(program))
+
+
+def read_file(path):
+    "All the expressions in a file, read as it streams in"
+    with open(path) as f:
+        return list(read_all(tokenize_file(f)))
+
+
 def standard_env():
     import math, operator as op
 
@@ -102,12 +148,35 @@ def schemestr(exp):
 
 
 class Procedure(object):
-    def __init__(self, params, body, env):
+    def __init__(self, params, body, env, defines=0):
+        # body is the analyzed closure, env the frame the procedure was made in
         self.params, self.body, self.env = params, body, env
+        self.defines = (None,) * defines
 
     def __call__(self, *args):
-        # build environment with proc arguments matched to parameters
-        return evaL(self.body, Env(self.params, args, self.env))
+        # Trampoline: calls in tail position of the body come back as a
+        # TailCall to run here, so tail recursion takes constant stack
+        proc = self
+        while True:
+            # build a frame with proc arguments in the slots of parameters,
+            # then slots for local defines and last a link to the outer frame
+            if len(args) != len(proc.params):
+                raise TypeError(
+                    f"expected {len(proc.params)} arguments, got {len(args)}"
+                )
+            result = proc.body([*args, *proc.defines, proc.env])
+            if type(result) is not TailCall:
+                return result
+            proc, args = result.proc, result.args
+
+
+class TailCall(object):
+    "A Procedure call left for the caller's trampoline"
+
+    __slots__ = ("proc", "args")
+
+    def __init__(self, proc, args):
+        self.proc, self.args = proc, args
 
 
 class Env(dict):
@@ -125,27 +194,291 @@ global_env = standard_env()
 
 
 def evaL(x, env=global_env):
+    return analyze(x, None, env)(None)
+
+
+class Scope(object):
+    "Compile time layout of a frame: variable names by slot, and outer Scope"
+
+    def __init__(self, names, outer):
+        self.names, self.outer = names, outer
+
+    def resolve(self, var):
+        "(depth, slot) of a local variable, None for globals"
+        depth, scope = 0, self
+        while scope is not None:
+            if var in scope.names:
+                return depth, scope.names.index(var)
+            depth, scope = depth + 1, scope.outer
+        return None
+
+
+def defined_names(x):
+    "Variables a lambda body defines, they get slots in its frame"
+    if not isinstance(x, List) or not x or x[0] in ("quote", "lambda"):
+        return []
+    names = [x[1]] if x[0] == "define" else []
+    for exp in x[1:]:
+        names.extend(defined_names(exp))
+    return names
+
+
+def analyze(x, scope, genv, tail=False):
+    """
+    Compile an expression once into a closure that evaluates it in a frame.
+    Local variables are resolved to their (depth, slot) in the frames,
+    global ones are looked up in genv. Procedure calls in tail position
+    return a TailCall instead of calling.
+    """
     if isinstance(x, Symbol):  # variable reference
-        return env.find(x)[x]
+        address = scope.resolve(x) if scope else None
+        return analyze_global(x, genv) if address is None else analyze_local(*address)
     elif not isinstance(x, List):  # const literal
-        return x
+        return lambda frame: x
     elif x[0] == "quote":  # (quote exp)
         (_, exp) = x
-        return exp
+        return lambda frame: exp
     elif x[0] == "if":  # (if test conseq alt)
         (_, test, conseq, alt) = x
-        exp = conseq if evaL(test, env) else alt
-        return evaL(exp, env)
-    elif x[0] == "define":  # (define var exp)
-        (_, var, exp) = x
-        env[var] = evaL(exp, env)
-    elif x[0] == "set!":  # (set! var exp)
+        test = analyze(test, scope, genv)
+        conseq = analyze(conseq, scope, genv, tail)
+        alt = analyze(alt, scope, genv, tail)
+        return lambda frame: conseq(frame) if test(frame) else alt(frame)
+    elif x[0] == "begin":  # (begin exp...) last exp in tail position
+        exps = [analyze(exp, scope, genv) for exp in x[1:-1]]
+        last = analyze(x[-1], scope, genv, tail)
+
+        def begin(frame):
+            for exp in exps:
+                exp(frame)
+            return last(frame)
+
+        return begin
+    elif x[0] in ("define", "set!"):  # (define var exp) (set! var exp)
         (_, var, exp) = x
-        env.find(var)[var] = evaL(exp, env)
+        value = analyze(exp, scope, genv)
+        address = scope.resolve(var) if scope else None
+        if address is not None:
+            depth, slot = address
+
+            def assign(frame):
+                val, target = value(frame), frame
+                for _ in range(depth):
+                    target = target[-1]
+                target[slot] = val
+
+            return assign
+        elif x[0] == "define":
+
+            def define(frame):
+                genv[var] = value(frame)
+
+            return define
+        else:
+
+            def set_(frame):
+                genv.find(var)[var] = value(frame)
+
+            return set_
     elif x[0] == "lambda":  # (lambda (var...) body)
         (_, params, body) = x
-        return Procedure(params, body, env)
+        defines = [v for v in dict.fromkeys(defined_names(body)) if v not in params]
+        body = analyze(body, Scope(list(params) + defines, scope), genv, tail=True)
+        return lambda frame: Procedure(params, body, frame, len(defines))
     else:  # (proc arg...)
-        proc = evaL(x[0], env)
-        args = [evaL(arg, env) for arg in x[1:]]
-        return proc(*args)
+        proc = analyze(x[0], scope, genv)
+        args = [analyze(arg, scope, genv) for arg in x[1:]]
+        if tail:
+            return analyze_tail_call(proc, args)
+        return analyze_application(proc, args)
+
+
+def analyze_local(depth, slot):
+    "Shallow frames are reached without looping"
+    if depth == 0:
+        return lambda frame: frame[slot]
+    elif depth == 1:
+        return lambda frame: frame[-1][slot]
+    elif depth == 2:
+        return lambda frame: frame[-1][-1][slot]
+
+    def lookup(frame):
+        for _ in range(depth):
+            frame = frame[-1]
+        return frame[slot]
+
+    return lookup
+
+
+def analyze_global(var, genv):
+    def lookup(frame):
+        try:
+            return genv[var]
+        except KeyError:  # genv may have outer Envs
+            return genv.find(var)[var]
+
+    return lookup
+
+
+def analyze_tail_call(proc, args):
+    "Primitives are called right away, Procedures by the caller's trampoline"
+    if len(args) == 1:
+        (arg,) = args
+
+        def tail_call(frame):
+            fn, value = proc(frame), arg(frame)
+            return TailCall(fn, (value,)) if type(fn) is Procedure else fn(value)
+
+    elif len(args) == 2:
+        arg0, arg1 = args
+
+        def tail_call(frame):
+            fn, value0, value1 = proc(frame), arg0(frame), arg1(frame)
+            if type(fn) is Procedure:
+                return TailCall(fn, (value0, value1))
+            return fn(value0, value1)
+
+    else:
+
+        def tail_call(frame):
+            fn, values = proc(frame), [arg(frame) for arg in args]
+            return TailCall(fn, values) if type(fn) is Procedure else fn(*values)
+
+    return tail_call
+
+
+def analyze_application(proc, args):
+    "Calls with few arguments skip building the argument list"
+    if len(args) == 0:
+        return lambda frame: proc(frame)()
+    elif len(args) == 1:
+        (arg,) = args
+        return lambda frame: proc(frame)(arg(frame))
+    elif len(args) == 2:
+        arg0, arg1 = args
+        return lambda frame: proc(frame)(arg0(frame), arg1(frame))
+    elif len(args) == 3:
+        arg0, arg1, arg2 = args
+        return lambda frame: proc(frame)(arg0(frame), arg1(frame), arg2(frame))
+    return lambda frame: proc(frame)(*[arg(frame) for arg in args])
+
+
+class LisTest(unittest.TestCase):
+    def run_program(self, program, env=None):
+        "Evaluate all the expressions of program, returns the last value"
+        env = standard_env() if env is None else env
+        for x in parse_all(program):
+            val = evaL(x, env)
+        return val
+
+    def test_tail_calls(self):
+        # tail recursion runs in constant python stack
+        loop = (
+            "(define loop (lambda (n acc) (if (= n 0) acc (loop (- n 1) (+ acc n)))))"
+        )
+        self.assertEqual(self.run_program(loop + "(loop 100000 0)"), 5000050000)
+        # also between procedures
+        even_odd = """
+            (define even? (lambda (n) (if (= n 0) 1 (odd? (- n 1)))))
+            (define odd? (lambda (n) (if (= n 0) 0 (even? (- n 1)))))
+        """
+        self.assertEqual(self.run_program(even_odd + "(even? 100001)"), 0)
+        # last expression of begin is in tail position, the others are not
+        countdown = """
+            (define calls 0)
+            (define countdown (lambda (n)
+              (begin (set! calls (+ calls 1)) (if (= n 0) calls (countdown (- n 1))))))
+            (define twice (lambda (n) (begin (countdown n) (countdown n))))
+        """
+        self.assertEqual(self.run_program(countdown + "(twice 50000)"), 100002)
+        # a procedure called by a primitive in tail position returns its value
+        apply_map = """
+            (define inc (lambda (x) (+ x 1)))
+            (define apply-loop (lambda (n) (apply loop n 0)))
+            (define incs (lambda (L) (map inc L)))
+        """
+        env = standard_env()
+        self.run_program(loop + apply_map, env)
+        self.assertEqual(evaL(parse("(apply-loop 100000)"), env), 5000050000)
+        self.assertEqual(list(evaL(parse("(incs (list 1 2 3))"), env)), [2, 3, 4])
+
+    def test_lexical_addressing(self):
+        # set! on a variable of an enclosing frame is seen by later calls
+        counter = """
+            (define make-counter (lambda (n)
+              (lambda () (begin (set! n (+ n 1)) n))))
+            (define c (make-counter 10))
+            (define other (make-counter 0))
+            (c) (c) (other)
+        """
+        self.assertEqual(self.run_program(counter + "(c)"), 13)
+        # internal defines get a slot in the frame, read from nested lambdas
+        internal = """
+            (define f (lambda (x)
+              (begin (define y (* x 2)) ((lambda (z) (+ y z)) x))))
+        """
+        self.assertEqual(self.run_program(internal + "(f 5)"), 15)
+        with self.assertRaises(TypeError):
+            self.run_program(internal + "(f 1 2)")
+        # globals missing from the environment are found in its outer Envs
+        outer = standard_env()
+        env = Env(["x"], [1], outer)
+        evaL(parse("(define add (lambda (y) (+ x y)))"), env)
+        self.assertEqual(evaL(parse("(add 2)"), env), 3)
+        evaL(parse("(set! abs (lambda (y) y))"), env)
+        self.assertEqual(outer["abs"](-1), -1)
+
+    def test_evaluation(self):
+        # Same values as the tree-walking evaluator this one replaced
+        env = standard_env()
+        programs = [
+            ("(define fact (lambda (n) (if (<= n 1) 1 (* n (fact (- n 1))))))", None),
+            ("(fact 20)", 2432902008176640000),
+            (
+                "(define fib (lambda (n)"
+                " (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2))))))",
+                None,
+            ),
+            ("(fib 15)", 610),
+            ("(quote (a (b 1) 2.5))", ["a", ["b", 1], 2.5]),
+            ("(if (> 1 2) (quote yes) (quote no))", "no"),
+            ("(define r 3)", None),
+            ("(* pi (* r r))", 28.274333882308138),
+            ("(begin (define x 1) (set! x (+ x 1)) x)", 2),
+        ]
+        for program, expected in programs:
+            self.assertEqual(evaL(parse(program), env), expected, program)
+
+    def test_reader(self):
+        program = "(define x 1) (+ x\n 2.5) sym"
+        self.assertEqual(
+            list(parse_all(program)), [["define", "x", 1], ["+", "x", 2.5], "sym"]
+        )
+        self.assertEqual(list(read_all(tokenize(program))), list(parse_all(program)))
+        # a token list loses the tokens read, an iterator advances past them
+        tokens = tokenize(program)
+        self.assertEqual(read_from_tokens(tokens), ["define", "x", 1])
+        self.assertEqual(tokens, ["(", "+", "x", "2.5", ")", "sym"])
+        expressions = []
+        while tokens:
+            expressions.append(read_from_tokens(tokens))
+        self.assertEqual(expressions, [["+", "x", 2.5], "sym"])
+        tokens = iter(tokenize(program))
+        self.assertEqual(read_from_tokens(tokens), ["define", "x", 1])
+        self.assertEqual(read_from_tokens(tokens), ["+", "x", 2.5])
+        # deep nesting doesn't recurse
+        self.assertEqual(len(parse("(" * 5000 + ")" * 5000)), 1)
+        with tempfile.NamedTemporaryFile("w", suffix=".scm") as f:
+            f.write("(define (x)\n  y)\nz\n")
+            f.flush()
+            with open(f.name) as lines:
+                self.assertEqual(
+                    list(tokenize_file(lines)),
+                    ["(", "define", "(", "x", ")", "y", ")", "z"],
+                )
+            self.assertEqual(read_file(f.name), [["define", ["x"], "y"], "z"])
+        with self.assertRaisesRegex(SyntaxError, "unexpected '\\)'"):
+            list(parse_all("(f x))"))
+        for program in ("(f (g x)", ""):
+            with self.assertRaisesRegex(SyntaxError, "unexpected EOF"):
+                parse(program)
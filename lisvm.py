@@ -0,0 +1,428 @@
+#!/usr/bin/env python
+
+# Bytecode backend for lis.py: programs parsed by lis are compiled into
+# arrays of opcodes and a constant pool, then run by a stack VM that keeps
+# its own call stack, so neither deep recursion nor tail calls grow python's.
+#   ./lisvm.py                        repl
+#   ./lisvm.py dis "(lambda (n) n)"   show the bytecode of an expression
+#   ./lisvm.py bench                  compare with the lis evaluators
+# The VM runs 2-3x faster than the tree-walking evaluator lis started with,
+# but at about a third of the speed of lis.evaL, which compiles to python
+# closures. What it buys is bounded python stack depth: non-tail recursion
+# as deep as memory allows, where the other evaluators hit python's limit.
+
+import io
+import sys
+import time
+import unittest
+from array import array
+
+import lis
+from lis import List, Symbol
+
+# Opcodes, followed by their operands in the code array
+CONST = 0  # index in consts: push the constant
+LOCAL0 = 1  # slot: push a variable of the current frame
+LOCAL = 2  # depth, slot: push a variable of an outer frame
+GLOBAL = 3  # index of the name in consts: push a global variable
+STORE = 4  # depth, slot: pop into a frame variable, push None
+DEFINE = 5  # index of the name in consts: pop into a global, push None
+SET = 6  # index of the name in consts: pop into an existing global, push None
+POP = 7
+JUMP = 8  # target
+JUMP_IF_FALSE = 9  # target: pop, jump if false
+CLOSURE = 10  # index of the Code in consts: push a Closure over the frame
+CALL = 11  # number of arguments: pop them and the procedure, push the result
+TAIL_CALL = 12  # number of arguments: like CALL, reusing the caller's return
+RETURN = 13  # pop the result, return it to the caller
+
+OPNAMES = [
+    "CONST", "LOCAL0", "LOCAL", "GLOBAL", "STORE", "DEFINE", "SET", "POP",
+    "JUMP", "JUMP_IF_FALSE", "CLOSURE", "CALL", "TAIL_CALL", "RETURN",
+]  # fmt: skip
+OPERANDS = [1, 1, 2, 1, 2, 1, 1, 0, 1, 1, 1, 1, 1, 0]
+
+
+class Code(object):
+    "Compiled body of a lambda, or of a top level expression"
+
+    def __init__(self, name, params, defines):
+        self.name, self.params = name, params
+        self.defines = (None,) * len(defines)
+        self.ops = array("i")
+        self.consts = []
+        self.const_ids = {}  # dedups hashable constants
+
+    def emit(self, *ops):
+        "Append an instruction, returns its position"
+        position = len(self.ops)
+        self.ops.extend(ops)
+        return position
+
+    def const(self, value):
+        "Index of value in the constant pool"
+        try:
+            key = (type(value), value)
+            if key not in self.const_ids:
+                self.const_ids[key] = len(self.consts)
+                self.consts.append(value)
+            return self.const_ids[key]
+        except TypeError:  # unhashable, like quoted lists
+            self.consts.append(value)
+            return len(self.consts) - 1
+
+
+class Closure(object):
+    "A compiled procedure and the frame it was created in"
+
+    def __init__(self, code, env, genv):
+        self.code, self.env, self.genv = code, env, genv
+
+    def __call__(self, *args):
+        # called from python, eg: by map
+        return execute(self.code, new_frame(self, args), self.genv)
+
+
+def new_frame(closure, args):
+    "Frames are laid out as in lis: arguments, local defines, outer frame"
+    code = closure.code
+    if len(args) != len(code.params):
+        raise TypeError(f"expected {len(code.params)} arguments, got {len(args)}")
+    return [*args, *code.defines, closure.env]
+
+
+def compile_program(x):
+    "Compile a top level expression"
+    code = Code("<toplevel>", (), ())
+    compile_expr(x, None, code, tail=True)
+    code.emit(RETURN)
+    return code
+
+
+def compile_lambda(params, body, scope, name="<lambda>"):
+    defines = [v for v in dict.fromkeys(lis.defined_names(body)) if v not in params]
+    code = Code(name, params, defines)
+    compile_expr(body, lis.Scope(list(params) + defines, scope), code, tail=True)
+    code.emit(RETURN)
+    return code
+
+
+def compile_expr(x, scope, code, tail):
+    "Emit code leaving the value of x on the stack"
+    if isinstance(x, Symbol):  # variable reference
+        address = scope.resolve(x) if scope else None
+        if address is None:
+            code.emit(GLOBAL, code.const(x))
+        elif address[0] == 0:
+            code.emit(LOCAL0, address[1])
+        else:
+            code.emit(LOCAL, *address)
+    elif not isinstance(x, List):  # const literal
+        code.emit(CONST, code.const(x))
+    elif x[0] == "quote":  # (quote exp)
+        (_, exp) = x
+        code.emit(CONST, code.const(exp))
+    elif x[0] == "if":  # (if test conseq alt)
+        (_, test, conseq, alt) = x
+        compile_expr(test, scope, code, False)
+        jump_alt = code.emit(JUMP_IF_FALSE, -1)
+        compile_expr(conseq, scope, code, tail)
+        # In tail position the end of the if is a RETURN, skip the jump
+        jump_end = code.emit(RETURN) if tail else code.emit(JUMP, -1)
+        code.ops[jump_alt + 1] = len(code.ops)
+        compile_expr(alt, scope, code, tail)
+        if not tail:
+            code.ops[jump_end + 1] = len(code.ops)
+    elif x[0] == "begin":  # (begin exp...) last exp in tail position
+        for exp in x[1:-1]:
+            compile_expr(exp, scope, code, False)
+            code.emit(POP)
+        compile_expr(x[-1], scope, code, tail)
+    elif x[0] in ("define", "set!"):  # (define var exp) (set! var exp)
+        (_, var, exp) = x
+        compile_expr(exp, scope, code, False)
+        address = scope.resolve(var) if scope else None
+        if address is not None:
+            code.emit(STORE, *address)
+        else:
+            code.emit(DEFINE if x[0] == "define" else SET, code.const(var))
+    elif x[0] == "lambda":  # (lambda (var...) body)
+        (_, params, body) = x
+        code.emit(CLOSURE, code.const(compile_lambda(params, body, scope)))
+    else:  # (proc arg...)
+        for exp in x:
+            compile_expr(exp, scope, code, False)
+        code.emit(TAIL_CALL if tail else CALL, len(x) - 1)
+
+
+def execute(code, frame, genv):
+    "Run code in frame until it returns"
+    ops, consts, pc = code.ops, code.consts, 0
+    stack = []
+    calls = []  # return addresses: (ops, consts, pc, frame)
+    while True:
+        op = ops[pc]
+        if op == LOCAL0:
+            stack.append(frame[ops[pc + 1]])
+            pc += 2
+        elif op == CONST:
+            stack.append(consts[ops[pc + 1]])
+            pc += 2
+        elif op == GLOBAL:
+            name = consts[ops[pc + 1]]
+            try:
+                stack.append(genv[name])
+            except KeyError:  # genv may have outer Envs
+                stack.append(genv.find(name)[name])
+            pc += 2
+        elif op == CALL or op == TAIL_CALL:
+            base = len(stack) - ops[pc + 1]
+            fn, args = stack[base - 1], stack[base:]
+            del stack[base - 1 :]
+            if type(fn) is Closure:
+                callee_frame = new_frame(fn, args)
+                # Tail calls return straight to the caller's caller
+                if op == CALL:
+                    calls.append((ops, consts, pc + 2, frame))
+                ops, consts, pc, frame = fn.code.ops, fn.code.consts, 0, callee_frame
+            else:
+                stack.append(fn(*args))
+                pc += 2
+        elif op == JUMP_IF_FALSE:
+            pc = pc + 2 if stack.pop() else ops[pc + 1]
+        elif op == JUMP:
+            pc = ops[pc + 1]
+        elif op == RETURN:
+            if not calls:
+                return stack.pop()
+            # leave the result on the stack for the caller
+            ops, consts, pc, frame = calls.pop()
+        elif op == LOCAL:
+            target = frame
+            for _ in range(ops[pc + 1]):
+                target = target[-1]
+            stack.append(target[ops[pc + 2]])
+            pc += 3
+        elif op == CLOSURE:
+            stack.append(Closure(consts[ops[pc + 1]], frame, genv))
+            pc += 2
+        elif op == POP:
+            stack.pop()
+            pc += 1
+        elif op == STORE:
+            target = frame
+            for _ in range(ops[pc + 1]):
+                target = target[-1]
+            target[ops[pc + 2]] = stack[-1]
+            stack[-1] = None
+            pc += 3
+        elif op == DEFINE:
+            genv[consts[ops[pc + 1]]] = stack[-1]
+            stack[-1] = None
+            pc += 2
+        elif op == SET:
+            name = consts[ops[pc + 1]]
+            genv.find(name)[name] = stack[-1]
+            stack[-1] = None
+            pc += 2
+        else:
+            raise RuntimeError(f"Bad opcode {op} at {pc}")
+
+
+def disassemble(code, out=sys.stdout):
+    "Print the instructions of code, then those of the lambdas in it"
+    params = " ".join(code.params)
+    size = len(code.params) + len(code.defines)
+    print(f"{code.name} ({params}) frame: {size}", file=out)
+    pc = 0
+    while pc < len(code.ops):
+        op = code.ops[pc]
+        operands = list(code.ops[pc + 1 : pc + 1 + OPERANDS[op]])
+        line = f"{pc:6} {OPNAMES[op]:14} {' '.join(map(str, operands)):8}"
+        if op in (CONST, GLOBAL, DEFINE, SET):
+            line += f" ; {lis.schemestr(code.consts[operands[0]])}"
+        elif op == CLOSURE:
+            line += f" ; {code.consts[operands[0]].name}"
+        print(line.rstrip(), file=out)
+        pc += 1 + OPERANDS[op]
+    for const in code.consts:
+        if isinstance(const, Code):
+            print(file=out)
+            disassemble(const, out)
+
+
+def evaL(x, env=lis.global_env):
+    return execute(compile_program(x), None, env)
+
+
+def repl(prompt="vm> "):
+    while True:
+        val = evaL(lis.parse(input(prompt)))
+        if val is not None:
+            print(lis.schemestr(val))
+
+
+class WalkProcedure(object):
+    "Procedure of walk_evaL"
+
+    def __init__(self, params, body, env):
+        self.params, self.body, self.env = params, body, env
+
+    def __call__(self, *args):
+        return walk_evaL(self.body, lis.Env(self.params, args, self.env))
+
+
+def walk_evaL(x, env=lis.global_env):
+    "The tree-walking evaluator lis.evaL replaced, the baseline of benchmark"
+    if isinstance(x, Symbol):  # variable reference
+        return env.find(x)[x]
+    elif not isinstance(x, List):  # const literal
+        return x
+    elif x[0] == "quote":  # (quote exp)
+        (_, exp) = x
+        return exp
+    elif x[0] == "if":  # (if test conseq alt)
+        (_, test, conseq, alt) = x
+        exp = conseq if walk_evaL(test, env) else alt
+        return walk_evaL(exp, env)
+    elif x[0] == "define":  # (define var exp)
+        (_, var, exp) = x
+        env[var] = walk_evaL(exp, env)
+    elif x[0] == "set!":  # (set! var exp)
+        (_, var, exp) = x
+        env.find(var)[var] = walk_evaL(exp, env)
+    elif x[0] == "lambda":  # (lambda (var...) body)
+        (_, params, body) = x
+        return WalkProcedure(params, body, env)
+    else:  # (proc arg...)
+        proc = walk_evaL(x[0], env)
+        args = [walk_evaL(arg, env) for arg in x[1:]]
+        return proc(*args)
+
+
+BACKENDS = [("tree-walk", walk_evaL), ("lis.evaL", lis.evaL), ("lisvm", evaL)]
+
+BENCHMARKS = [
+    (
+        "fib 20",
+        "(define fib (lambda (n) (if (< n 2) n (+ (fib (- n 1)) (fib (- n 2))))))",
+        "(fib 20)",
+    ),
+    (
+        "tail loop 100000",
+        "(define loop (lambda (n acc) (if (= n 0) acc (loop (- n 1) (+ acc n)))))",
+        "(loop 100000 0)",
+    ),
+    (
+        "closures 20000",
+        "(define compose (lambda (f g) (lambda (x) (f (g x)))))"
+        " (define inc (lambda (x) (+ x 1)))"
+        " (define times (lambda (n f x) (if (= n 0) x (times (- n 1) f (f x)))))",
+        "(times 20000 (compose inc inc) 0)",
+    ),
+    (
+        "count list 150",
+        "(define range (lambda (n) (if (= n 0) (list) (cons n (range (- n 1))))))"
+        " (define count (lambda (item L) (if (null? L) 0"
+        " (+ (if (equal? item (first L)) 1 0) (count item (tail L))))))",
+        "(count 7 (range 150))",
+    ),
+]
+
+
+def run_benchmark(backend, setup, program, repeat=1):
+    "Best time and result of program on a backend, after running setup"
+    env = lis.standard_env()
+    # setup may hold many definitions, wrap them to read them at once
+    backend(lis.parse(f"(begin {setup} 0)"), env)
+    x = lis.parse(program)
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = backend(x, env)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def benchmark(repeat=3):
+    "Best time of each program on every backend, speedup of lisvm over them"
+    names = [name for name, _ in BACKENDS]
+    print(f"{'':20}" + "".join(f" {name:>10}" for name in names), end="")
+    print("".join(f" {'vs ' + name:>13}" for name in names[:-1]))
+    for name, setup, program in BENCHMARKS:
+        timings, results = [], []
+        for _, backend in BACKENDS:
+            try:
+                best, result = run_benchmark(backend, setup, program, repeat)
+            except RecursionError:  # the tree walker recurses on tail calls
+                best, result = None, None
+            timings.append(best)
+            if best is not None:
+                results.append(result)
+        assert all(result == results[-1] for result in results), f"{name}: {results}"
+        row = "".join(
+            f" {'too deep' if t is None else f'{t:.4f}':>10}" for t in timings
+        )
+        row += "".join(
+            f" {'-' if t is None else f'{t / timings[-1]:.2f}x':>13}"
+            for t in timings[:-1]
+        )
+        print(f"{name:20}{row}")
+
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "bench":
+        benchmark()
+    elif len(sys.argv) > 2 and sys.argv[1] == "dis":
+        disassemble(compile_program(lis.parse(sys.argv[2])))
+    else:
+        repl()
+
+
+class LisvmTest(unittest.TestCase):
+    def test_benchmarks_match_lis(self):
+        for name, setup, program in BENCHMARKS:
+            _, expected = run_benchmark(evaL, setup, program)
+            self.assertEqual(run_benchmark(lis.evaL, setup, program)[1], expected, name)
+            try:
+                self.assertEqual(run_benchmark(walk_evaL, setup, program)[1], expected)
+            except RecursionError:  # no tail calls in the tree walker
+                pass
+
+    def test_deep_recursion(self):
+        # Calls in the VM don't use python's stack, unlike in lis.evaL
+        env = lis.standard_env()
+        count = "(define count (lambda (n) (if (= n 0) 0 (+ 1 (count (- n 1))))))"
+        evaL(lis.parse(count), env)
+        self.assertEqual(evaL(lis.parse("(count 50000)"), env), 50000)
+
+    def test_disassemble(self):
+        out = io.StringIO()
+        program = "(define f (lambda (n) (if n (f (- n 1)) (quote done))))"
+        disassemble(compile_program(lis.parse(program)), out)
+        self.assertEqual(
+            [line.split() for line in out.getvalue().splitlines()],
+            [
+                ["<toplevel>", "()", "frame:", "0"],
+                ["0", "CLOSURE", "0", ";", "<lambda>"],
+                ["2", "DEFINE", "1", ";", "f"],
+                ["4", "RETURN"],
+                [],
+                ["<lambda>", "(n)", "frame:", "1"],
+                ["0", "LOCAL0", "0"],
+                ["2", "JUMP_IF_FALSE", "17"],
+                ["4", "GLOBAL", "0", ";", "f"],
+                ["6", "GLOBAL", "1", ";", "-"],
+                ["8", "LOCAL0", "0"],
+                ["10", "CONST", "2", ";", "1"],
+                ["12", "CALL", "2"],
+                ["14", "TAIL_CALL", "1"],
+                ["16", "RETURN"],
+                ["17", "CONST", "3", ";", "done"],
+                ["19", "RETURN"],
+            ],
+        )
+
+
+if __name__ == "__main__":
+    main()